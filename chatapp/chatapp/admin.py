@@ -1,6 +1,22 @@
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User, Message
+from django.db.models import Max, Min, Q
+from django.http import HttpResponseBadRequest
+from django.urls import reverse
+from django.utils.html import format_html
+
+from . import history
+from .archive import pair_messages
+from .models import Conversation, Message, MessageArchive, User
+
+# Above this many rows the changelist shows an estimate instead of counting
+COUNT_LIMIT = getattr(settings, 'CHAT_ADMIN_COUNT_LIMIT', 10000)
+
+CURSOR_VAR = 'cursor'
+
 
 class UserAdmin(BaseUserAdmin):
     list_display = ('username', 'email', 'is_therapist', 'is_staff', 'is_superuser')
@@ -9,5 +25,146 @@ class UserAdmin(BaseUserAdmin):
         (None, {'fields': ('is_therapist',)}),
     )
 
+
+def estimated_count(queryset, limit=COUNT_LIMIT):
+    """Return (count, exact). Counting stops after `limit` rows."""
+    count = queryset.order_by()[:limit + 1].count()
+    if count <= limit:
+        return count, True
+    if not queryset.query.has_filters():
+        # Ids only ever grow, so the id range is close enough and both
+        # ends come straight off the primary key
+        bounds = queryset.model.objects.aggregate(low=Min('id'), high=Max('id'))
+        return max(bounds['high'] - bounds['low'] + 1, count), False
+    return limit, False
+
+
+class ConversationFilter(admin.SimpleListFilter):
+    # Reached from the conversation changelist. Listing every conversation
+    # here would mean loading all of them, so only the selected one shows.
+    title = 'conversation'
+    parameter_name = 'conversation'
+
+    def lookups(self, request, model_admin):
+        value = self.value()
+        self.conversation = None
+        if value is None:
+            return []
+        if value.isdigit():
+            self.conversation = Conversation.objects.select_related('user_a', 'user_b').filter(pk=value).first()
+        if self.conversation is None:
+            return [(value, f'#{value}')]
+        return [(value, f'{self.conversation.user_a} <-> {self.conversation.user_b}')]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        if self.conversation is None:
+            return queryset.none()
+        # Both directions of message_pair_time_idx
+        return queryset & pair_messages(self.conversation.user_a_id, self.conversation.user_b_id)
+
+
+class MessageChangeList(ChangeList):
+    # Keyset pagination: ?cursor= is the history cursor of the last row on
+    # the previous page, so a deep page costs the same as the first one
+    # instead of an OFFSET over millions of rows.
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_ordering(self, request, queryset):
+        # Fixed, the cursor only works in this order
+        return ['-timestamp', '-id']
+
+    def get_results(self, request):
+        cursor = request.GET.get(CURSOR_VAR)
+        queryset = self.queryset
+        if cursor:
+            try:
+                ts, msg_id = history.decode_cursor(cursor)
+            except ValueError:
+                raise IncorrectLookupParameters('Invalid cursor')
+            queryset = queryset.filter(Q(timestamp__lt=ts) | Q(timestamp=ts, id__lt=msg_id))
+        page = list(queryset[:self.list_per_page + 1])
+        self.next_cursor = None
+        if len(page) > self.list_per_page:
+            page = page[:self.list_per_page]
+            self.next_cursor = history.encode_cursor(page[-1])
+
+        self.result_count, self.count_exact = estimated_count(self.queryset)
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.result_list = page
+        self.can_show_all = False
+        self.multi_page = bool(cursor or self.next_cursor)
+        self.paginator = None
+
+    def get_cursor_url(self, cursor):
+        return self.get_query_string({CURSOR_VAR: cursor}) if cursor else self.get_query_string(remove=[CURSOR_VAR])
+
+    def newest_url(self):
+        return self.get_cursor_url(None)
+
+    def next_url(self):
+        return self.get_cursor_url(self.next_cursor)
+
+
+class MessageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'sender', 'receiver', 'short_content', 'timestamp', 'is_read')
+    list_select_related = ('sender', 'receiver')
+    list_filter = (('timestamp', admin.DateFieldListFilter), ConversationFilter)
+    ordering = ('-timestamp', '-id')
+    sortable_by = ()
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+    autocomplete_fields = ('sender', 'receiver')
+    raw_id_fields = ('attachment',)
+
+    def get_changelist(self, request, **kwargs):
+        return MessageChangeList
+
+    def changelist_view(self, request, extra_context=None):
+        # A bad cursor is the client's mistake, not a lookup to redirect away from
+        cursor = request.GET.get(CURSOR_VAR)
+        if cursor:
+            try:
+                history.decode_cursor(cursor)
+            except ValueError:
+                return HttpResponseBadRequest('Invalid cursor')
+        return super().changelist_view(request, extra_context)
+
+    @admin.display(description='content')
+    def short_content(self, obj):
+        return obj.content[:20]
+
+
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user_a', 'user_b', 'last_timestamp', 'unread_a', 'unread_b', 'message_link')
+    list_select_related = ('user_a', 'user_b')
+    ordering = ('-id',)
+    show_full_result_count = False
+    autocomplete_fields = ('user_a', 'user_b')
+    raw_id_fields = ('last_message',)
+
+    @admin.display(description='messages')
+    def message_link(self, obj):
+        url = reverse('admin:chatapp_message_changelist')
+        return format_html('<a href="{}?conversation={}">View</a>', url, obj.id)
+
+
+class MessageArchiveAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user_a', 'user_b', 'first_timestamp', 'last_timestamp', 'count')
+    list_select_related = ('user_a', 'user_b')
+    ordering = ('-id',)
+    show_full_result_count = False
+    raw_id_fields = ('user_a', 'user_b')
+    exclude = ('data',)
+
+
 admin.site.register(User, UserAdmin)
-admin.site.register(Message)
+admin.site.register(Message, MessageAdmin)
+admin.site.register(Conversation, ConversationAdmin)
+admin.site.register(MessageArchive, MessageArchiveAdmin)
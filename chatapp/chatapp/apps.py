@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ChatappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatapp'
+
+    def ready(self):
+        from . import archive, attachments, auth, contact_search, directory, metrics  # noqa: F401 connect signals and lifespan hooks
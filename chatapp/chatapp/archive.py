@@ -0,0 +1,219 @@
+"""
+Cold tier for old messages.
+
+archive_old_messages() moves read messages older than CHAT_ARCHIVE_AFTER_DAYS
+out of chatapp_message into MessageArchive chunks, one conversation at a
+time and oldest first. A conversation is only archived up to its first
+unread message (and never its last_message), so archived messages are
+always older than every hot message of the same pair and history can
+simply continue into the archive once the hot table runs out. Archived
+messages stay searchable through their own full-text index, see
+chatapp.search.
+"""
+import asyncio
+import json
+import logging
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import lifespan, search
+from .models import Conversation, Message, MessageArchive, User
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+AFTER_DAYS = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 180)
+CHUNK_SIZE = getattr(settings, 'CHAT_ARCHIVE_CHUNK_SIZE', 500)
+LOCK_PATH = getattr(settings, 'CHAT_ARCHIVE_LOCK', None)
+
+FIELDS = ('id', 'sender_id', 'receiver_id', 'content', 'timestamp', 'is_read', 'attachment_id')
+
+
+def encode_chunk(rows):
+    lines = []
+    for row in rows:
+        row = dict(row, timestamp=row['timestamp'].isoformat())
+        lines.append(json.dumps(row, separators=(',', ':')))
+    return zlib.compress('\n'.join(lines).encode())
+
+
+def decode_rows(data):
+    rows = []
+    for line in zlib.decompress(data).decode().split('\n'):
+        row = json.loads(line)
+        row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+        rows.append(row)
+    return rows
+
+
+def decode_chunk(data):
+    return [Message(**row) for row in decode_rows(data)]
+
+
+def pair_messages(a, b):
+    return Message.objects.filter(Q(sender_id=a, receiver_id=b) | Q(sender_id=b, receiver_id=a))
+
+
+def archive_conversation(conversation, cutoff, chunk_size=CHUNK_SIZE):
+    """Archive one conversation's old messages, return how many moved."""
+    a, b = conversation.user_a_id, conversation.user_b_id
+    old = pair_messages(a, b).filter(timestamp__lt=cutoff)
+    keep = Q(is_read=False)
+    if conversation.last_message_id:
+        keep |= Q(id=conversation.last_message_id)
+    stop = old.filter(keep).order_by('timestamp', 'id').values('timestamp', 'id').first()
+    if stop:
+        old = old.filter(Q(timestamp__lt=stop['timestamp']) | Q(timestamp=stop['timestamp'], id__lt=stop['id']))
+
+    moved = 0
+    while True:
+        rows = list(old.order_by('timestamp', 'id').values(*FIELDS)[:chunk_size])
+        if not rows:
+            return moved
+        ids = [row['id'] for row in rows]
+        with transaction.atomic():
+            MessageArchive.objects.create(
+                user_a_id=a, user_b_id=b,
+                first_id=rows[0]['id'], first_timestamp=rows[0]['timestamp'],
+                last_id=rows[-1]['id'], last_timestamp=rows[-1]['timestamp'],
+                count=len(rows), data=encode_chunk(rows),
+            )
+            # Deleting the rows takes them out of the message index
+            if connection.vendor == 'sqlite':
+                search.index_archived(rows)
+            # Another worker got here first, don't archive the rows twice
+            if Message.objects.filter(id__in=ids).delete()[1].get('chatapp.Message', 0) != len(ids):
+                raise RuntimeError('Messages changed while archiving')
+        moved += len(rows)
+
+
+def archive_old_messages(days=AFTER_DAYS, chunk_size=CHUNK_SIZE):
+    cutoff = timezone.now() - timedelta(days=days)
+    moved = 0
+    for conversation in Conversation.objects.iterator():
+        moved += archive_conversation(conversation, cutoff, chunk_size)
+    return moved
+
+
+def reindex():
+    """Rebuild the search index of archived messages from the chunks, return how many."""
+    indexed = 0
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM chatapp_archive_fts')
+        for chunk in MessageArchive.objects.only('data').iterator(chunk_size=4):
+            rows = decode_rows(chunk.data)
+            search.index_archived(rows)
+            indexed += len(rows)
+    return indexed
+
+
+def pair_chunks(user, other_user):
+    a, b = Conversation.pair(user.id, other_user.id)
+    return MessageArchive.objects.filter(user_a_id=a, user_b_id=b)
+
+
+def messages_before(user, other_user, before=None, limit=50):
+    """Return up to `limit` archived messages older than (timestamp, id) `before`, newest first."""
+    chunks = pair_chunks(user, other_user)
+    if before:
+        ts, msg_id = before
+        chunks = chunks.filter(Q(first_timestamp__lt=ts) | Q(first_timestamp=ts, first_id__lt=msg_id))
+    # Plain users so serialize_message never has to look the sender up
+    senders = {
+        user.id: User(id=user.id, username=user.username),
+        other_user.id: User(id=other_user.id, username=other_user.username),
+    }
+
+    page = []
+    for chunk in chunks.order_by('-last_timestamp', '-last_id').only('data').iterator(chunk_size=4):
+        for message in reversed(decode_chunk(chunk.data)):
+            if before and (message.timestamp, message.id) >= before:
+                continue
+            message.sender = senders[message.sender_id]
+            page.append(message)
+            if len(page) == limit:
+                return page
+    return page
+
+
+def find_message(user, msg_id):
+    """Return archived message msg_id if user sent or received it, else None."""
+    chunks = MessageArchive.objects.filter(
+        Q(user_a_id=user.id) | Q(user_b_id=user.id), first_id__lte=msg_id, last_id__gte=msg_id,
+    )
+    for chunk in chunks.only('data').iterator(chunk_size=4):
+        for message in decode_chunk(chunk.data):
+            if message.id == msg_id:
+                return message
+    return None
+
+
+@contextmanager
+def archiver_lock():
+    """Yield True in the one process allowed to archive right now, False elsewhere."""
+    if fcntl is None or not LOCK_PATH:
+        yield True
+        return
+    with open(LOCK_PATH, 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def archive_pass():
+    # Runs in a thread of its own, with its own connection, so the worker's
+    # views and sockets don't queue behind it on the sync_to_async thread.
+    # Every runworkers process schedules it, the lock lets one of them run.
+    try:
+        with archiver_lock() as acquired:
+            if not acquired:
+                return 0
+            return archive_old_messages()
+    finally:
+        connections.close_all()
+
+
+async def archive_periodically(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            moved = await asyncio.to_thread(archive_pass)
+        except Exception:
+            logger.exception('Archiving messages failed')
+        else:
+            if moved:
+                logger.info('Archived %s messages', moved)
+
+
+_task = None
+
+
+@lifespan.on_startup
+async def start_archiver():
+    global _task
+    interval = getattr(settings, 'CHAT_ARCHIVE_INTERVAL', 0)
+    if interval:
+        _task = asyncio.get_running_loop().create_task(archive_periodically(interval))
+
+
+@lifespan.on_shutdown
+async def stop_archiver():
+    if _task is not None:
+        _task.cancel()
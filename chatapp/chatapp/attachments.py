@@ -0,0 +1,263 @@
+"""
+File attachments.
+
+Uploads arrive over the chat socket (see ChatConsumer.receive_upload): the
+client announces name, size and sha256, the server answers with the offset
+to start from, and the bytes follow as binary frames of an 8 byte big-endian
+offset plus data. Each chunk is appended to a partial file as it arrives,
+and the partial file is keyed by user and hash, so a client that lost its
+socket announces the same file again and carries on where it stopped.
+
+Finished files are stored once per hash under CHAT_ATTACHMENT_ROOT. The
+client always sends the bytes, even for a file we already have, because
+skipping the transfer on a known hash would hand the file to anyone who
+knows its hash.
+"""
+import asyncio
+import contextlib
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header
+
+from . import lifespan
+
+logger = logging.getLogger(__name__)
+
+ROOT = settings.CHAT_ATTACHMENT_ROOT
+MAX_BYTES = getattr(settings, 'CHAT_ATTACHMENT_MAX_BYTES', 25 * 1024 * 1024)
+CHUNK_BYTES = getattr(settings, 'CHAT_ATTACHMENT_CHUNK_BYTES', 64 * 1024)
+MAX_PARTIALS = getattr(settings, 'CHAT_ATTACHMENT_MAX_PARTIALS', 5)
+MAX_PARTIAL_BYTES = getattr(settings, 'CHAT_ATTACHMENT_MAX_PARTIAL_BYTES', 100 * 1024 * 1024)
+BLOCK_SIZE = 64 * 1024
+
+HEADER_BYTES = 8  # chunk offset
+SHA256 = re.compile(r'^[0-9a-f]{64}$')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def blob_path(sha256):
+    return os.path.join(ROOT, sha256[:2], sha256)
+
+
+class Upload:
+    """One file being received over a chat socket."""
+
+    def __init__(self, user_id, name, size, sha256):
+        if not isinstance(name, str) or not os.path.basename(name).strip():
+            raise ValueError('Invalid file name')
+        if not isinstance(size, int) or isinstance(size, bool) or not 0 <= size <= MAX_BYTES:
+            raise ValueError('File too large' if isinstance(size, int) and size > MAX_BYTES else 'Invalid file size')
+        if not isinstance(sha256, str) or not SHA256.match(sha256):
+            raise ValueError('Invalid checksum')
+        self.name = os.path.basename(name).strip()[:255]
+        self.size = size
+        self.sha256 = sha256
+        self.user_id = user_id
+        self.path = os.path.join(ROOT, 'partial', f'{user_id}-{sha256}')
+        self.file = None
+        self.offset = 0
+
+    @property
+    def done(self):
+        return self.offset == self.size
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.check_quota()
+        self.hasher = hashlib.sha256()
+        # Resuming: hash what an earlier socket already wrote
+        if os.path.exists(self.path) and os.path.getsize(self.path) <= self.size:
+            with open(self.path, 'rb') as existing:
+                for block in iter(lambda: existing.read(BLOCK_SIZE), b''):
+                    self.hasher.update(block)
+            self.file = open(self.path, 'ab')
+        else:
+            self.file = open(self.path, 'wb')
+        self.offset = self.file.tell()
+
+    def check_quota(self):
+        """ValueError if starting this file would leave the user too many unfinished ones."""
+        count = used = 0
+        for entry in os.scandir(os.path.dirname(self.path)):
+            # Resuming this file doesn't count against it
+            if not entry.name.startswith(f'{self.user_id}-') or entry.path == self.path:
+                continue
+            try:
+                used += entry.stat().st_size
+            except FileNotFoundError:
+                continue  # finished or swept meanwhile
+            count += 1
+        if count >= MAX_PARTIALS or used + self.size > MAX_PARTIAL_BYTES:
+            raise ValueError('Too many unfinished uploads')
+
+    def write(self, data):
+        self.file.write(data)
+        # Flushed, so the offset we report is what a resume will find
+        self.file.flush()
+        self.hasher.update(data)
+        self.offset += len(data)
+
+    def finish(self):
+        """Check the complete file, ValueError if it isn't the announced one."""
+        self.close()
+        if self.hasher.hexdigest() != self.sha256:
+            os.remove(self.path)
+            raise ValueError('Checksum mismatch')
+
+    def store(self):
+        # Called by ChatConsumer.save_message inside the transaction that
+        # creates the Attachment row, so there is never a blob without one.
+        # Until then the file stays in partial/ and expires like any other.
+        path = blob_path(self.sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.path, path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def remove_stale_partials(max_age):
+    """Delete partial uploads nobody resumed within max_age seconds."""
+    directory = os.path.join(ROOT, 'partial')
+    if not os.path.isdir(directory):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(directory):
+        # Another worker's sweep, or the upload finishing, can get there first
+        with contextlib.suppress(FileNotFoundError):
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+    return removed
+
+
+async def clean_periodically(max_age):
+    while True:
+        try:
+            removed = await asyncio.to_thread(remove_stale_partials, max_age)
+        except OSError:
+            logger.exception('Removing stale uploads failed')
+        else:
+            if removed:
+                logger.info('Removed %s stale uploads', removed)
+        await asyncio.sleep(max_age / 4)
+
+
+_task = None
+
+
+@lifespan.on_startup
+async def start_cleaner():
+    global _task
+    max_age = getattr(settings, 'CHAT_ATTACHMENT_PARTIAL_TTL', 0)
+    if max_age:
+        _task = asyncio.get_running_loop().create_task(clean_periodically(max_age))
+
+
+@lifespan.on_shutdown
+async def stop_cleaner():
+    if _task is not None:
+        _task.cancel()
+
+
+def parse_range(header, size):
+    """
+    Return (start, end) inclusive for a single byte range, None to send the
+    whole file, or False when the range can't be satisfied. Multi-range
+    requests get the whole file, which RFC 9110 allows.
+    """
+    match = RANGE.match(header.strip())
+    if not match or size == 0:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # Suffix range, the last N bytes; the last 0 can't be satisfied
+        if int(last) == 0:
+            return False
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size:
+        return False
+    if start > end:
+        return None
+    return start, end
+
+
+def read_blocks(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(BLOCK_SIZE, length))
+            if not block:
+                return
+            length -= len(block)
+            yield block
+
+
+async def aiter_blocks(blocks):
+    # Under ASGI a sync iterator would be read into memory whole before
+    # sending, so read it block by block off the event loop instead
+    blocks = iter(blocks)
+    take = sync_to_async(lambda: next(blocks, None), thread_sensitive=False)
+    while True:
+        block = await take()
+        if block is None:
+            return
+        yield block
+
+
+def serve(request, attachment, name):
+    """Response for downloading `attachment` as `name`, honouring Range."""
+    # Content addressed, so the hash is a perfect ETag and never goes stale
+    tag = f'"{attachment.sha256}"'
+    response = get_conditional_response(request, etag=tag)
+    if response is None:
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        byte_range = None
+        if request.META.get('HTTP_RANGE') and request.META.get('HTTP_IF_RANGE', tag) == tag:
+            byte_range = parse_range(request.META['HTTP_RANGE'], attachment.size)
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{attachment.size}'
+        elif settings.CHAT_ATTACHMENT_ACCEL_REDIRECT:
+            # The front end (nginx) sends the file and does the ranges itself
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = settings.CHAT_ATTACHMENT_ACCEL_REDIRECT + os.path.relpath(
+                blob_path(attachment.sha256), ROOT,
+            )
+        elif byte_range is None and not isinstance(request, ASGIRequest):
+            # Lets the WSGI server use sendfile
+            response = FileResponse(open(blob_path(attachment.sha256), 'rb'), content_type=content_type)
+        else:
+            start, end = byte_range or (0, attachment.size - 1)
+            blocks = read_blocks(blob_path(attachment.sha256), start, end - start + 1)
+            if isinstance(request, ASGIRequest):
+                blocks = aiter_blocks(blocks)
+            response = StreamingHttpResponse(blocks, status=206 if byte_range else 200, content_type=content_type)
+            response['Content-Length'] = end - start + 1
+            if byte_range:
+                response['Content-Range'] = f'bytes {start}-{end}/{attachment.size}'
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Disposition'] = content_disposition_header(True, name)
+        # Never let the browser render an upload as a page
+        response['X-Content-Type-Options'] = 'nosniff'
+    response['ETag'] = tag
+    patch_cache_control(response, private=True, max_age=365 * 24 * 60 * 60, immutable=True)
+    return response
@@ -0,0 +1,136 @@
+"""
+Cached authentication for HTTP and websockets.
+
+Django's get_user() costs a user query on every request and Channels'
+AuthMiddleware the same on every connect, on top of loading the session.
+With the cached_db session engine the session comes from the cache, and
+get_user() here keeps the User there too, so a reconnect storm is served
+from memory. The cached copy is still checked against the session's auth
+hash; anything that doesn't verify goes the normal Django way, which also
+deals with rotated secret keys and logs stale sessions out. Saving or
+deleting a user and logging out drop the cached copy.
+"""
+from functools import partial
+from types import SimpleNamespace
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from channels.auth import AuthMiddleware
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.decorators import login_required as django_login_required, user_passes_test
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.signals import user_logged_out
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+
+from .models import User
+
+TIMEOUT = getattr(settings, 'CHAT_AUTH_CACHE_TIMEOUT', 300)
+
+
+def _key(user_id):
+    return f'chat:auth:user:{user_id}'
+
+
+def get_user(request):
+    """Like django.contrib.auth.get_user(), but from the cache when it can."""
+    session = request.session
+    try:
+        user_id = User._meta.pk.to_python(session[SESSION_KEY])
+        backend_path = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return auth.get_user(request)
+
+    # Cached copies are unpickled, so no two requests share an instance
+    user = cache.get(_key(user_id))
+    session_hash = session.get(HASH_SESSION_KEY)
+    if (
+        user is not None
+        and backend_path in settings.AUTHENTICATION_BACKENDS
+        and session_hash
+        and constant_time_compare(session_hash, user.get_session_auth_hash())
+    ):
+        user.backend = backend_path
+        return user
+
+    user = auth.get_user(request)
+    if user.is_authenticated:
+        cache.set(_key(user.id), user, TIMEOUT)
+    return user
+
+
+def invalidate(user_id):
+    cache.delete(_key(user_id))
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # Logins only touch last_login, which nothing checks
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    invalidate(instance.id)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    invalidate(instance.id)
+
+
+@receiver(user_logged_out)
+def logged_out(sender, request, user, **kwargs):
+    if user is not None:
+        invalidate(user.id)
+
+
+async def auser(request):
+    if not hasattr(request, '_acached_user'):
+        request._acached_user = await sync_to_async(get_user)(request)
+        # Async views read request.user afterwards (templates too), which
+        # must not go back to the session from the event loop
+        request.user = request._acached_user
+    return request._acached_user
+
+
+async def _is_authenticated(user):
+    return user.is_authenticated
+
+
+def login_required(view):
+    # Django's version reads is_authenticated through sync_to_async on
+    # async views, one more trip to the sync thread per request
+    if iscoroutinefunction(view):
+        return user_passes_test(_is_authenticated)(view)
+    return django_login_required(view)
+
+
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    """Drop-in for Django's AuthenticationMiddleware."""
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: get_user(request))
+        request.auser = partial(auser, request)
+
+    async def __acall__(self, request):
+        # process_request only sets up lazy attributes, no need to run it
+        # on the sync thread
+        self.process_request(request)
+        return await self.get_response(request)
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """Drop-in for Channels' AuthMiddleware."""
+
+    async def resolve_scope(self, scope):
+        # auth.get_user() only ever looks at request.session
+        scope['user']._wrapped = await database_sync_to_async(get_user)(SimpleNamespace(session=scope['session']))
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
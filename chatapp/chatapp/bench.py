@@ -0,0 +1,358 @@
+"""
+Load benchmark for ChatConsumer.
+
+Opens one client and one therapist socket per pair, has every client send
+messages at a fixed rate and measures how long each one takes to reach the
+therapist's socket. Runs in-process through WebsocketCommunicator, or
+against a running server (e.g. uvicorn) when a ws:// URL is given.
+
+run_http() does the same for the inbox and room pages: every client and
+therapist loads them concurrently through Django's ASGI handler, with the
+conversation changing between rounds so the pages are rebuilt, not served
+from the render cache.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+import tracemalloc
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.db import connection
+
+from . import versions
+from .directory import directory
+from .models import Conversation, Message, User
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PREFIX = 'bench_'
+RECEIVE_TIMEOUT = 10
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def create_users(pairs):
+    delete_users()
+    therapists = User.objects.bulk_create([
+        User(username=f'{PREFIX}t{i}', is_therapist=True) for i in range(pairs)
+    ])
+    clients = User.objects.bulk_create([
+        User(username=f'{PREFIX}c{i}') for i in range(pairs)
+    ])
+    return list(zip(clients, therapists))
+
+
+def delete_users():
+    User.objects.filter(username__startswith=PREFIX).delete()
+    directory.clear()
+
+
+def session_cookie(user):
+    from importlib import import_module
+
+    store = import_module(settings.SESSION_ENGINE).SessionStore()
+    store[SESSION_KEY] = str(user.pk)
+    store[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    store.create()
+    return f'{settings.SESSION_COOKIE_NAME}={store.session_key}'
+
+
+class InProcessSocket:
+    def __init__(self, user, path):
+        from channels.routing import URLRouter
+        from channels.testing import WebsocketCommunicator
+
+        from .routing import websocket_urlpatterns
+
+        self.communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        self.communicator.scope['user'] = user
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError('Socket was rejected')
+
+    async def send(self, data):
+        await self.communicator.send_to(text_data=data)
+
+    async def recv(self):
+        return await self.communicator.receive_from(timeout=RECEIVE_TIMEOUT)
+
+    async def close(self):
+        # A receive that timed out has already stopped the consumer
+        if not self.communicator.future.done():
+            await self.communicator.disconnect()
+
+
+class RemoteSocket:
+    def __init__(self, url, path, cookie):
+        self.url = url.rstrip('/') + path
+        self.cookie = cookie
+        self.ws = None
+
+    async def connect(self):
+        import websockets
+
+        self.ws = await websockets.connect(self.url, additional_headers={'Cookie': self.cookie})
+
+    async def send(self, data):
+        await self.ws.send(data)
+
+    async def recv(self):
+        return await asyncio.wait_for(self.ws.recv(), RECEIVE_TIMEOUT)
+
+    async def close(self):
+        await self.ws.close()
+
+
+async def _drain(socket, count):
+    # The sender gets its own messages back from the group, or an error
+    # when the server's rate limit turned one away. Read them so its
+    # channel never fills up, and return how many were rejected.
+    rejected = 0
+    for _ in range(count):
+        try:
+            frame = json.loads(await socket.recv())
+        except Exception:
+            break
+        if isinstance(frame, dict) and frame.get('error') == 'Rate limit exceeded':
+            rejected += 1
+    return rejected
+
+
+async def _receive(socket, count, latencies):
+    received = 0
+    while received < count:
+        try:
+            frame = json.loads(await socket.recv())
+        except Exception:
+            break
+        if frame.get('type', 'message') != 'message' or not frame.get('message', '').startswith('bench '):
+            continue
+        sent_ns = int(frame['message'].split()[1])
+        latencies.append((time.monotonic_ns() - sent_ns) / 1e6)
+        received += 1
+    return received
+
+
+async def _send(socket, count, rate):
+    interval = 1 / rate if rate else 0
+    # Spread pairs out so they don't all fire on the same tick
+    await asyncio.sleep(random.random() * interval)
+    for _ in range(count):
+        await socket.send(json.dumps({'message': f'bench {time.monotonic_ns()}'}))
+        if interval:
+            await asyncio.sleep(interval)
+
+
+async def run_load(pairs, messages, rate, url=None):
+    sockets = []
+    for client, therapist in pairs:
+        if url:
+            client_cookie = await sync_to_async(session_cookie)(client)
+            therapist_cookie = await sync_to_async(session_cookie)(therapist)
+            sender = RemoteSocket(url, f'/ws/chat/{therapist.username}/', client_cookie)
+            receiver = RemoteSocket(url, f'/ws/chat/{client.username}/', therapist_cookie)
+        else:
+            sender = InProcessSocket(client, f'/ws/chat/{therapist.username}/')
+            receiver = InProcessSocket(therapist, f'/ws/chat/{client.username}/')
+        sockets.append((sender, receiver))
+
+    if not url:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0] if not url else 0
+    for sender, receiver in sockets:
+        await receiver.connect()
+        await sender.connect()
+    per_connection = None
+    if not url:
+        per_connection = (tracemalloc.get_traced_memory()[0] - before) / (2 * len(sockets))
+        tracemalloc.stop()
+
+    latencies = []
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *[_receive(receiver, messages, latencies) for _, receiver in sockets],
+        *[_send(sender, messages, rate) for sender, _ in sockets],
+        *[_drain(sender, messages) for sender, _ in sockets],
+    )
+    duration = time.perf_counter() - started
+    delivered = sum(results[:len(sockets)])
+    rejected = sum(results[-len(sockets):])
+
+    for sender, receiver in sockets:
+        await sender.close()
+        await receiver.close()
+    return latencies, delivered, rejected, duration, per_connection
+
+
+def create_history(pairs, messages):
+    rows = []
+    for client, therapist in pairs:
+        for n in range(messages):
+            sender, receiver = (client, therapist) if n % 2 else (therapist, client)
+            rows.append(Message(sender=sender, receiver=receiver, content=f'history {n}', is_read=True))
+    Conversation.record_messages(Message.objects.bulk_create(rows, batch_size=1000))
+
+
+async def _browse(user, other, rounds, latencies):
+    from django.test import AsyncClient
+
+    client = AsyncClient()
+    await client.aforce_login(user)
+    for _ in range(rounds):
+        # A new message in the conversation, as far as the caches can tell
+        versions.bump_conversation(user.id, other.id)
+        for path in ('/chat/', f'/chat/{other.username}/'):
+            started = time.perf_counter()
+            response = await client.get(path)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise RuntimeError(f'{path} returned {response.status_code}')
+
+
+async def run_browse(pairs, rounds):
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        _browse(user, other, rounds, latencies)
+        for client, therapist in pairs
+        for user, other in ((client, therapist), (therapist, client))
+    ])
+    return latencies, time.perf_counter() - started
+
+
+def run_http(pairs=50, rounds=10, history=50, keep_data=False):
+    """Benchmark chat_home and chat_view under concurrent load, return the report as a dict."""
+    from asgiref.sync import async_to_sync
+
+    from django.test.utils import override_settings
+
+    users = create_users(pairs)
+    try:
+        create_history(users, history)
+        # The test client's host, as the test runner allows it
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            latencies, duration = async_to_sync(run_browse)(users, rounds)
+    finally:
+        if not keep_data:
+            delete_users()
+
+    return {
+        'config': {
+            'pairs': pairs,
+            'rounds': rounds,
+            'history_per_pair': history,
+            'target': 'in-process http',
+            'pid': os.getpid(),
+        },
+        'results': {
+            'requests': len(latencies),
+            'duration_s': round(duration, 3),
+            'requests_per_s': round(len(latencies) / duration, 1) if duration else None,
+            'latency_ms': {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'max': max(latencies) if latencies else None,
+            },
+        },
+    }
+
+
+def run(pairs=100, messages=10, rate=5.0, url=None, keep_data=False):
+    """Run one benchmark and return the report as a dict."""
+    from asgiref.sync import async_to_sync
+
+    from django.test.utils import override_settings
+
+    # In-process the bench measures the consumer, not the rate limit, so
+    # every client may send all its messages at once. A remote server
+    # keeps its own limit and rejected messages are reported.
+    limits = {} if url else {'CHAT_RATE_BURST': max(settings.CHAT_RATE_BURST, messages)}
+    users = create_users(pairs)
+    writes = []
+
+    def count_writes(execute, sql, params, many, context):
+        if sql.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            writes.append(1)
+        return execute(sql, params, many, context)
+
+    user_ids = [user.id for pair in users for user in pair]
+    try:
+        with connection.execute_wrapper(count_writes), override_settings(**limits):
+            latencies, delivered, rejected, duration, per_connection = async_to_sync(run_load)(users, messages, rate, url)
+        stored = Message.objects.filter(sender_id__in=user_ids).count()
+    finally:
+        if not keep_data:
+            delete_users()
+
+    sent = pairs * messages
+    return {
+        'config': {
+            'pairs': pairs,
+            'messages_per_client': messages,
+            'rate_per_client': rate,
+            'target': url or 'in-process',
+            'write_behind': getattr(settings, 'CHAT_WRITE_BEHIND', False),
+            'pid': os.getpid(),
+        },
+        'results': {
+            'messages_sent': sent,
+            'messages_delivered': delivered,
+            'messages_rejected': rejected,
+            'messages_stored': stored,
+            'duration_s': round(duration, 3),
+            'messages_per_s': round(delivered / duration, 1) if duration else None,
+            'latency_ms': {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'max': max(latencies) if latencies else None,
+            },
+            # Write statements are only visible when the consumers run in-process
+            'db_writes_per_s': round(len(writes) / duration, 1) if duration and not url else None,
+            'messages_stored_per_s': round(stored / duration, 1) if duration else None,
+            'memory_per_connection_bytes': round(per_connection) if per_connection is not None else None,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+        },
+    }
+
+
+# Lower is better for these, higher for everything else compared
+LOWER_IS_BETTER = {'p50', 'p95', 'p99', 'max', 'memory_per_connection_bytes', 'duration_s'}
+COMPARED = ['messages_per_s', 'requests_per_s', 'db_writes_per_s', 'memory_per_connection_bytes', 'latency_ms.p50', 'latency_ms.p95', 'latency_ms.p99']
+
+
+def _lookup(report, key):
+    value = report['results']
+    for part in key.split('.'):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def compare(report, baseline, tolerance=0.10):
+    """Return [(metric, baseline, current, change, regressed)]."""
+    rows = []
+    for key in COMPARED:
+        old, new = _lookup(baseline, key), _lookup(report, key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = change > tolerance if key.split('.')[-1] in LOWER_IS_BETTER else change < -tolerance
+        rows.append((key, old, new, change, worse))
+    return rows
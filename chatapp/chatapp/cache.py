@@ -0,0 +1,30 @@
+"""
+Cache backend shared by the runworkers processes.
+
+Django's FileBasedCache lists the whole cache directory on every set() to
+decide whether to cull, which with tens of thousands of rendered fragments
+stalls the event loop of whichever view or consumer wrote. This one checks
+at most every CULL_INTERVAL seconds per process, in a background thread,
+so a set() is one temp file and one rename.
+"""
+import threading
+import time
+
+from django.core.cache.backends.filebased import FileBasedCache
+
+
+class SharedFileCache(FileBasedCache):
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        options = params.get('OPTIONS') or {}
+        self._cull_interval = int(options.get('CULL_INTERVAL', 60))
+        self._next_cull = 0
+        self._cull_lock = threading.Lock()
+
+    def _cull(self):
+        now = time.monotonic()
+        with self._cull_lock:
+            if now < self._next_cull:
+                return
+            self._next_cull = now + self._cull_interval
+        threading.Thread(target=super()._cull, name='chat-cache-cull', daemon=True).start()
@@ -1,14 +1,63 @@
+import asyncio
 import json
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.contrib.auth import get_user_model
-from .models import Message
-from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
+from .models import Attachment, Message, Conversation
+from . import dbwriter, history, writebehind
+from .attachments import CHUNK_BYTES, HEADER_BYTES, Upload
+from .directory import directory
+from .flowcontrol import SendQueue, TokenBucket
+from .metrics import BATCH_EVENTS, CONNECTIONS, FANOUT, FRAMES, FRAMES_TOO_LARGE, RATE_LIMITED, RECEIVE_SECONDS, REPLAYED, TYPING_EVENTS, UPLOAD_BYTES, UPLOAD_THROTTLED
+from .presence import presence
+
+# Sockets per room in this process, for the fan-out metric
+room_members = {}
+
+
+def notify_group(user_id):
+    # Every socket a user has open on /ws/notify/, see NotifyConsumer
+    return f'user_{user_id}'
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.other_user = self.scope['url_route']['kwargs']['username']
         self.user = self.scope['user']
+        self.pending_writes = set()
+        self.read_ack = None  # pending read receipt, see receive_read
+        self.read_flush = None
+        self.upload = None  # attachment being received, see receive_upload
+        # Typing indicator, see receive_typing
+        self.typing = False  # what the room was last told
+        self.typing_wanted = False
+        self.typing_started = 0.0
+        self.typing_flush = None
+        self.typing_expire = None
+        # Inbound rate limit and bounded outbound queue, see flowcontrol
+        self.rate_limit = TokenBucket(settings.CHAT_RATE_LIMIT, settings.CHAT_RATE_BURST)
+        self.upload_budget = TokenBucket(settings.CHAT_ATTACHMENT_BYTES_PER_SECOND, settings.CHAT_ATTACHMENT_BURST_BYTES)
+        self.outbound = SendQueue(self.send_now, settings.CHAT_SEND_QUEUE_SIZE, settings.CHAT_SEND_OVERFLOW)
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        # ?v=2 clients get events batched into compact frames, see queue_event
+        self.batched = params.get('v') == ['2']
+        self.replayed_upto = 0  # live events up to this id were already replayed
+        self.batch = []
+        self.batch_flush = None
         self.room_group_name = f'chat_{min(self.user.username, self.other_user)}_{max(self.user.username, self.other_user)}'
+        self.receiver = None
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        # Resolve the receiver once, from the shared user directory
+        self.receiver = await directory.aget(self.other_user)
+        if self.receiver is None:
+            await self.close()
+            return
 
         # Join chat group
         await self.channel_layer.group_add(
@@ -16,46 +65,452 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         await self.accept()
+        await asyncio.to_thread(presence.connect, self.user.id)
+        CONNECTIONS.inc()
+        room_members[self.room_group_name] = room_members.get(self.room_group_name, 0) + 1
+
+        # A reconnecting client sends the last id it saw. Live events wait
+        # in our channel until connect returns, so they can't overtake the
+        # replay, and chat_message drops the ones the replay already sent.
+        after = params.get('after', [''])[0]
+        if after.isdigit():
+            await self.replay(int(after))
 
     async def disconnect(self, close_code):
+        if self.batch_flush is not None:
+            self.batch_flush.cancel()
+        self.outbound.close()
+        if self.upload is not None:
+            # The partial file stays, a new socket can resume it
+            await asyncio.to_thread(self.upload.close)
+        if self.receiver is None:
+            return
+        # Nobody types on a closed socket
+        self.clear_typing()
+        if self.typing:
+            self.typing = False
+            await self.broadcast_typing()
+        await asyncio.to_thread(presence.disconnect, self.user.id)
+        CONNECTIONS.dec()
+        members = room_members.pop(self.room_group_name, 1) - 1
+        if members:
+            room_members[self.room_group_name] = members
+        if self.read_flush is not None:
+            self.read_flush.cancel()
+            await self.flush_read()
         # Leave group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        # Wait for buffered messages from this socket to reach the DB
+        if self.pending_writes:
+            await asyncio.gather(*self.pending_writes, return_exceptions=True)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            await self.receive_chunk(bytes_data)
+            return
+        if len(text_data) > settings.CHAT_MAX_FRAME_BYTES or len(text_data.encode()) > settings.CHAT_MAX_FRAME_BYTES:
+            FRAMES_TOO_LARGE.inc()
+            await self.close(code=1009)
+            return
         data = json.loads(text_data)
-        message = data['message']
+        if not self.rate_limit.allow():
+            RATE_LIMITED.inc()
+            # Keyed so rejections piling up in a full queue collapse into one
+            await self.send_error('Rate limit exceeded', data.get('message'), key='rate-limit')
+            return
+        # Any frame proves the socket is alive
+        await asyncio.to_thread(presence.heartbeat, self.user.id)
+
+        frame_type = data.get('type', 'message')
+        # Unknown types share one label so clients can't grow the metric
+        FRAMES.inc(type=frame_type if frame_type in ('message', 'heartbeat', 'read', 'upload', 'typing') else 'other')
+        if frame_type == 'heartbeat':
+            return
+        if frame_type == 'typing':
+            self.receive_typing(data.get('typing', True))
+            return
+        if frame_type == 'read':
+            self.receive_read(data.get('upto'))
+            return
+        if frame_type == 'upload':
+            await self.receive_upload(data)
+            return
+        await self.receive_message(data['message'])
+
+    async def receive_upload(self, data):
+        # {'type': 'upload', 'name', 'size', 'sha256'} starts or resumes a
+        # file, we answer with the offset to send from (see send_offset).
+        # One upload per socket, announcing another abandons the current one.
+        if self.upload is not None:
+            await asyncio.to_thread(self.upload.close)
+            self.upload = None
+        try:
+            upload = Upload(self.user.id, data.get('name'), data.get('size'), data.get('sha256'))
+        except ValueError as exc:
+            await self.send_error(str(exc), data.get('name'))
+            return
+        try:
+            await asyncio.to_thread(upload.open)
+        except ValueError as exc:
+            await self.send_error(str(exc), upload.name)
+            return
+        self.upload = upload
+        await self.send_offset(upload)
+        if upload.done:
+            await self.finish_upload()
+
+    async def receive_chunk(self, data):
+        # 8 byte big-endian offset, then the bytes. Written to the partial
+        # file as it comes, nothing is held in memory past this frame.
+        if len(data) > CHUNK_BYTES + HEADER_BYTES:
+            FRAMES_TOO_LARGE.inc()
+            await self.close(code=1009)
+            return
+        # Chunks are paid for in bytes, at least a kilobyte each so a flood
+        # of tiny frames is held back too. Waiting delays the ack, and the
+        # client only sends a few chunks ahead of it, so it slows down.
+        wait = self.upload_budget.reserve(max(len(data), 1024))
+        if wait:
+            UPLOAD_THROTTLED.inc(wait)
+            await asyncio.sleep(wait)
+        FRAMES.inc(type='chunk')
+        upload = self.upload
+        if upload is None:
+            await self.send_error('No upload in progress', None)
+            return
+        offset = int.from_bytes(data[:HEADER_BYTES], 'big')
+        chunk = data[HEADER_BYTES:]
+        if offset != upload.offset or len(chunk) > upload.size - upload.offset:
+            await self.send_error('Unexpected chunk', upload.name)
+            return
+        await asyncio.to_thread(upload.write, chunk)
+        UPLOAD_BYTES.inc(len(chunk))
+        await self.send_offset(upload)
+        if upload.done:
+            await self.finish_upload()
+
+    async def send_offset(self, upload):
+        # Keyed, a newer offset supersedes a queued one
+        key = f'upload:{upload.sha256}'
+        if self.batched:
+            self.queue_event(['u', upload.sha256, upload.offset], key)
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'upload',
+            'sha256': upload.sha256,
+            'offset': upload.offset,
+        }), key=key)
+
+    async def finish_upload(self):
+        upload, self.upload = self.upload, None
+        try:
+            await asyncio.to_thread(upload.finish)
+        except ValueError as exc:
+            await self.send_error(str(exc), upload.name)
+            return
+        await self.receive_message(upload.name, upload)
+
+    async def receive_message(self, message, upload=None):
         sender = self.user
-        receiver_username = self.other_user
-
-        # Fetch receiver user from DB
-        User = get_user_model()
-        receiver = await sync_to_async(User.objects.get)(username=receiver_username)
-
-        # Save the message to DB
-        await sync_to_async(Message.objects.create)(
-            sender=sender,
-            receiver=receiver,
-            content=message,
-            is_read=False
-        )
+        started = time.perf_counter()
+        # The message itself ends the indicator on the other side
+        self.clear_typing()
+        self.typing = False
+
+        # The buffer only takes plain text, attachments are saved right away
+        if writebehind.enabled() and upload is None:
+            # Broadcast first, the buffer persists it a few ms later
+            self.buffer_message(Message(sender=sender, receiver_id=self.receiver.id, content=message, is_read=False))
+            msg_id, created = None, False
+        else:
+            # Save the message to DB and bump the conversation summary
+            msg, conversation = await dbwriter.write(self.save_message, sender, self.receiver.id, message, upload)
+            msg_id, created = msg.id, conversation.created
+        saved = time.perf_counter()
+        RECEIVE_SECONDS.observe(saved - started, phase='db')
 
         # Broadcast to group
+        FANOUT.observe(room_members.get(self.room_group_name, 0))
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 'type': 'chat_message',
+                'id': msg_id,
                 'message': message,
                 'sender': sender.username,
+                'attachment': reverse('attachment', args=[msg_id]) if upload else None,
                 'sending': False,
             }
         )
 
+        # Inbox updates for both users' other tabs. Write-behind can't know
+        # about new conversations yet, the inbox adds unknown contacts itself.
+        if created:
+            await self.notify(self.receiver.id, {'type': 'conversation', 'user': sender.username, 'is_therapist': sender.is_therapist})
+            await self.notify(sender.id, {'type': 'conversation', 'user': self.receiver.username, 'is_therapist': self.receiver.is_therapist})
+        await self.notify(self.receiver.id, {'type': 'unread', 'user': sender.username, 'is_therapist': sender.is_therapist, 'delta': 1})
+        await self.notify(sender.id, {'type': 'unread', 'user': self.receiver.username, 'is_therapist': self.receiver.is_therapist, 'delta': 0})
+        RECEIVE_SECONDS.observe(time.perf_counter() - saved, phase='broadcast')
+
+    async def notify(self, user_id, frame):
+        await self.channel_layer.group_send(notify_group(user_id), {'type': 'inbox_event', 'frame': frame})
+
     async def chat_message(self, event):
+        if event['id'] is not None and event['id'] <= self.replayed_upto:
+            return
+        if self.batched:
+            entry = ['m', event['id'], event['sender'], event['message']]
+            if event.get('attachment'):
+                entry.append(event['attachment'])
+            self.queue_event(entry)
+            return
         await self.send(text_data=json.dumps({
+            'type': 'message',
+            'id': event['id'],
             'message': event['message'],
             'sender': event['sender'],
+            'attachment': event.get('attachment'),
             'sending': True
         }))
+
+    async def replay(self, after_id):
+        after = await history.aanchor(after_id)
+        sent = 0
+        while after is not None:
+            batch = await history.aget_after(self.user, self.receiver, after, settings.CHAT_REPLAY_BATCH)
+            if not batch:
+                return
+            if sent + len(batch) > settings.CHAT_REPLAY_MAX:
+                break
+            # One frame per batch
+            if self.batched:
+                frame = [
+                    ['m', msg.id, msg.sender.username, msg.content] + ([reverse('attachment', args=[msg.id])] if msg.attachment_id else [])
+                    for msg in batch
+                ]
+            else:
+                frame = {'type': 'replay', 'messages': [history.serialize_message(msg) for msg in batch]}
+            await self.send(text_data=json.dumps(frame, separators=(',', ':')))
+            REPLAYED.inc(len(batch))
+            sent += len(batch)
+            after = (batch[-1].timestamp, batch[-1].id)
+            self.replayed_upto = batch[-1].id
+            if len(batch) < settings.CHAT_REPLAY_BATCH:
+                return
+        # Too far behind (or the message is archived): a reload is cheaper
+        await self.send(text_data=json.dumps([['s']] if self.batched else {'type': 'resync'}))
+
+    def receive_typing(self, typing):
+        # {'type': 'typing'} while the user types (clients repeat it every
+        # second or so) and {'type': 'typing', 'typing': false} when they
+        # stop. Never stored. Only changes reach the room, a start at most
+        # once per CHAT_TYPING_INTERVAL, and a start nobody repeats expires
+        # after CHAT_TYPING_TIMEOUT.
+        self.typing_wanted = bool(typing)
+        if self.typing_expire is not None:
+            self.typing_expire.cancel()
+            self.typing_expire = None
+        loop = asyncio.get_running_loop()
+        if self.typing_wanted:
+            self.typing_expire = loop.call_later(settings.CHAT_TYPING_TIMEOUT, self.receive_typing, False)
+        if self.typing_flush is not None or self.typing_wanted == self.typing:
+            return
+        delay = 0
+        if self.typing_wanted:
+            delay = max(0, self.typing_started + settings.CHAT_TYPING_INTERVAL - time.monotonic())
+        self.typing_flush = loop.call_later(delay, lambda: asyncio.ensure_future(self.flush_typing()))
+
+    async def flush_typing(self):
+        self.typing_flush = None
+        if self.typing_wanted == self.typing:
+            return  # started and stopped again within the interval
+        self.typing = self.typing_wanted
+        if self.typing:
+            self.typing_started = time.monotonic()
+        await self.broadcast_typing()
+
+    async def broadcast_typing(self):
+        TYPING_EVENTS.inc()
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'typing_event',
+                'user': self.user.username,
+                'typing': self.typing,
+            }
+        )
+
+    def clear_typing(self):
+        # Forget the indicator state without telling anyone
+        self.typing_wanted = False
+        for handle in (self.typing_flush, self.typing_expire):
+            if handle is not None:
+                handle.cancel()
+        self.typing_flush = self.typing_expire = None
+
+    async def typing_event(self, event):
+        if event['user'] == self.user.username:
+            return  # our own other tabs don't need it
+        # Only the latest state per user matters
+        key = f"typing:{event['user']}"
+        if self.batched:
+            self.queue_event(['t', event['user'], event['typing']], key)
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'typing',
+            'user': event['user'],
+            'typing': event['typing'],
+        }), key=key)
+
+    def receive_read(self, upto):
+        # Acks arriving within CHAT_READ_RECEIPT_DELAY collapse into one
+        # ranged UPDATE. upto=None (write-behind messages have no id yet)
+        # acknowledges everything received so far.
+        if upto is not None and not isinstance(upto, int):
+            return
+        if self.read_flush is None:
+            self.read_ack = upto
+            self.read_flush = asyncio.get_running_loop().call_later(
+                settings.CHAT_READ_RECEIPT_DELAY,
+                lambda: asyncio.ensure_future(self.flush_read()),
+            )
+        elif self.read_ack is not None:
+            self.read_ack = None if upto is None else max(self.read_ack, upto)
+
+    async def flush_read(self):
+        upto, self.read_ack, self.read_flush = self.read_ack, None, None
+        # Buffered messages have to be in the table before we can mark them
+        if upto is None and writebehind.enabled():
+            await writebehind.buffer.flush()
+        count = await dbwriter.write(Conversation.acknowledge, self.user, self.receiver, upto)
+        if count:
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    'type': 'read_receipt',
+                    'reader': self.user.username,
+                    'upto': upto,
+                }
+            )
+            await self.notify(self.user.id, {'type': 'unread', 'user': self.receiver.username, 'is_therapist': self.receiver.is_therapist, 'delta': -count})
+
+    async def read_receipt(self, event):
+        # A newer receipt from the same reader supersedes a queued one
+        key = f"read:{event['reader']}"
+        if self.batched:
+            self.queue_event(['r', event['reader'], event['upto']], key)
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'read',
+            'reader': event['reader'],
+            'upto': event['upto'],
+        }), key=key)
+
+    async def send_error(self, error, message, key=None):
+        if self.batched:
+            self.queue_event(['e', error, message], key)
+            return
+        await self.send(text_data=json.dumps({'error': error, 'message': message}), key=key)
+
+    def queue_event(self, event, key=None):
+        # Protocol v2: events arriving within CHAT_BATCH_WINDOW go out as
+        # one frame, a JSON array of [code, ...] entries:
+        #   ['m', id, sender, message(, attachment url)]  ['r', reader, upto]
+        #   ['e', error, message]  ['u', sha256, offset]  ['t', user, typing]
+        # and ['s'] when the client has to reload (see replay)
+        if key is not None:
+            self.batch = [entry for entry in self.batch if entry[0] != key]
+        self.batch.append((key, event))
+        if len(self.batch) >= settings.CHAT_BATCH_MAX:
+            if self.batch_flush is not None:
+                self.batch_flush.cancel()
+            self.batch_flush = None
+            asyncio.ensure_future(self.flush_batch())
+        elif self.batch_flush is None:
+            self.batch_flush = asyncio.get_running_loop().call_later(
+                settings.CHAT_BATCH_WINDOW,
+                lambda: asyncio.ensure_future(self.flush_batch()),
+            )
+
+    async def flush_batch(self):
+        batch, self.batch, self.batch_flush = self.batch, [], None
+        if not batch:
+            return
+        BATCH_EVENTS.observe(len(batch))
+        await self.send(text_data=json.dumps([event for _, event in batch], separators=(',', ':')))
+
+    async def send(self, text_data=None, bytes_data=None, close=False, key=None):
+        # Text frames go through the bounded queue instead of waiting on
+        # the client, see flowcontrol.SendQueue
+        if text_data is None or close:
+            await super().send(text_data, bytes_data, close)
+            return
+        if not self.outbound.put(text_data, key):
+            self.outbound.close()
+            await self.close(code=1013)
+
+    async def send_now(self, text_data):
+        await super().send(text_data=text_data)
+
+    def buffer_message(self, msg):
+        future = writebehind.buffer.add(msg)
+        self.pending_writes.add(future)
+
+        def written(future):
+            self.pending_writes.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                # Tell the sender their message was broadcast but not stored
+                asyncio.ensure_future(self.send_error('Message could not be saved', msg.content))
+
+        future.add_done_callback(written)
+
+    @staticmethod
+    def save_message(sender, receiver_id, content, upload=None):
+        with transaction.atomic():
+            attachment = None
+            if upload is not None:
+                # Same bytes, same row: the file is only stored once
+                attachment, _ = Attachment.objects.get_or_create(sha256=upload.sha256, defaults={'size': upload.size})
+            msg = Message.objects.create(
+                sender=sender,
+                receiver_id=receiver_id,
+                content=content,
+                attachment=attachment,
+                is_read=False
+            )
+            conversation = Conversation.record_message(msg)
+            if upload is not None:
+                # Last, so a failed move rolls the rows back
+                upload.store()
+        return msg, conversation
+
+
+class NotifyConsumer(AsyncWebsocketConsumer):
+    """Live inbox updates (unread deltas, new conversations) for every tab a user has open."""
+
+    async def connect(self):
+        self.user = self.scope['user']
+        self.group_name = None
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+        self.group_name = notify_group(self.user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        # An open inbox counts as online, like an open room
+        await asyncio.to_thread(presence.connect, self.user.id)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if self.group_name is not None:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            await asyncio.to_thread(presence.disconnect, self.user.id)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # The page only sends heartbeats
+        await asyncio.to_thread(presence.heartbeat, self.user.id)
+
+    async def inbox_event(self, event):
+        await self.send(text_data=json.dumps(event['frame']))
@@ -0,0 +1,104 @@
+from django.conf import settings
+from django.db.models import Count
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import ContactTrigram, User
+
+CANDIDATES = 50
+MIN_SIMILARITY = getattr(settings, 'CHAT_CONTACT_MIN_SIMILARITY', 0.2)
+
+
+def trigrams(text):
+    # Two leading spaces make the first grams prefix markers ("  a", " al"),
+    # so short queries still hit the index and rank prefix matches first
+    padded = f'  {text.lower()} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def index_user(user_id, username):
+    grams = trigrams(username)
+    existing = set(ContactTrigram.objects.filter(user_id=user_id).values_list('gram', flat=True))
+    if existing == grams:
+        return
+    ContactTrigram.objects.filter(user_id=user_id, gram__in=existing - grams).delete()
+    ContactTrigram.objects.bulk_create(
+        [ContactTrigram(user_id=user_id, gram=gram) for gram in grams - existing],
+        ignore_conflicts=True,
+    )
+
+
+def rank(query, username, hits):
+    query, name = query.lower(), username.lower()
+    grams = len(trigrams(query)) + len(trigrams(name))
+    score = hits / (grams - hits)  # Jaccard similarity of the trigram sets
+    if name == query:
+        score += 2
+    elif name.startswith(query):
+        score += 1
+    elif query in name:
+        # Short substrings score low on similarity alone, but a plain
+        # "contains" has to match, as it did before the index
+        score += 0.5
+    return score
+
+
+def filter_names(query, names):
+    """
+    Rank `names` (a list the caller already has, like an inbox) against
+    query in memory, return {name: score} for those that match. Unlike
+    search() nothing is capped: every substring match is kept, and fuzzy
+    ones need MIN_SIMILARITY.
+    """
+    query = query.strip()
+    grams = trigrams(query)
+    matches = {}
+    for name in names:
+        score = rank(query, name, len(grams & trigrams(name)))
+        if score >= MIN_SIMILARITY:
+            matches[name] = score
+    return matches
+
+
+def search(query, therapists=None, only_ids=None, limit=10):
+    """
+    Return [(user id, username, score)] best match first. `therapists`
+    narrows to therapists (True) or clients (False), `only_ids` to a set
+    of user ids the caller is allowed to see.
+    """
+    query = query.strip()
+    if not query:
+        return []
+    grams = trigrams(query)
+    candidates = ContactTrigram.objects.filter(gram__in=grams)
+    if therapists is not None:
+        candidates = candidates.filter(user__is_therapist=therapists)
+    if only_ids is not None:
+        candidates = candidates.filter(user_id__in=only_ids)
+    candidates = (
+        candidates.values('user_id', 'user__username')
+        .annotate(hits=Count('id'))
+        .order_by('-hits')[:CANDIDATES]
+    )
+
+    results = []
+    for row in candidates:
+        username = row['user__username']
+        score = rank(query, username, row['hits'])
+        if score >= MIN_SIMILARITY:
+            results.append((row['user_id'], username, score))
+    results.sort(key=lambda result: (-result[2], result[1]))
+    return results[:limit]
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    # Only creates and renames change the index
+    if update_fields is not None and 'username' not in update_fields:
+        return
+    if created:
+        ContactTrigram.objects.bulk_create(
+            [ContactTrigram(user_id=instance.id, gram=gram) for gram in trigrams(instance.username)]
+        )
+    else:
+        index_user(instance.id, instance.username)
@@ -0,0 +1,160 @@
+"""
+Single writer for SQLite.
+
+SQLite only ever lets one connection write, so with CHAT_DB_WRITER on every
+write from the consumers goes through one thread that owns its own
+connection. Whatever is queued when it wakes up is committed together in
+one transaction, each operation in its own savepoint so one failure does
+not take the rest of the batch with it. Reads go to the "read" alias
+(query_only connections to the same file, see ReadRouter), which WAL lets
+run while the writer commits. The server turns WAL on at startup, see
+start_wal.
+"""
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+
+from . import lifespan
+from .metrics import WRITE_BATCH, WRITE_QUEUE_WAIT, timed_sync_to_async
+
+READ_ALIAS = 'read'
+
+
+class WriteSerializer:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) for the writer thread and return a Future for its result."""
+        future = Future()
+        self._queue.put((func, args, kwargs, future, time.perf_counter()))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='chat-db-writer', daemon=True)
+                self._thread.start()
+        return future
+
+    def stop(self):
+        # Commit whatever is queued, then let the thread exit. A later
+        # submit() starts a new one.
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        try:
+            while True:
+                batch = [self._queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stopping = None in batch
+                batch = [op for op in batch if op is not None]
+                if batch:
+                    self._commit(batch)
+                if stopping:
+                    return
+        finally:
+            connection.close()
+
+    def _commit(self, batch):
+        started = time.perf_counter()
+        WRITE_BATCH.observe(len(batch))
+        results = []
+        try:
+            with transaction.atomic():
+                for func, args, kwargs, future, queued in batch:
+                    WRITE_QUEUE_WAIT.observe(started - queued)
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with transaction.atomic():
+                            results.append((future, None, func(*args, **kwargs)))
+                    except Exception as exc:
+                        results.append((future, exc, None))
+        except Exception as exc:
+            # The commit itself failed, nothing in this batch was written
+            connection.close()
+            for _, _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        # Only report success once the batch is durable
+        for future, exc, result in results:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+
+writer = WriteSerializer(batch_size=getattr(settings, 'CHAT_DB_WRITER_BATCH', 200))
+
+
+def enabled():
+    return getattr(settings, 'CHAT_DB_WRITER', False)
+
+
+async def write(func, *args, **kwargs):
+    """Run a sync DB write on the writer thread, or in sync_to_async when it is off."""
+    if not enabled():
+        return await timed_sync_to_async(func)(*args, **kwargs)
+    return await asyncio.wrap_future(writer.submit(func, *args, **kwargs))
+
+
+@lifespan.on_shutdown
+async def stop_writer():
+    await asyncio.to_thread(writer.stop)
+
+
+def use_wal(connection):
+    """Switch connection's database file to WAL, return the journal mode it ends up in."""
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        return cursor.fetchone()[0]
+
+
+def use_wal_on_default():
+    # The read alias is the same file, so one switch covers it
+    try:
+        return use_wal(connections[DEFAULT_DB_ALIAS])
+    finally:
+        connections.close_all()
+
+
+@lifespan.on_startup
+async def start_wal():
+    if getattr(settings, 'CHAT_SQLITE_WAL', False) and connections[DEFAULT_DB_ALIAS].vendor == 'sqlite':
+        await asyncio.to_thread(use_wal_on_default)
+
+
+class ReadRouter:
+    """Send reads to the read-only alias, everything else to default."""
+
+    def db_for_read(self, model, **hints):
+        # Inside a transaction we have to read our own uncommitted writes
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return READ_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Explicit, otherwise saving an instance loaded from the read alias
+        # would try to write through it
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # same file either way
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db == DEFAULT_DB_ALIAS
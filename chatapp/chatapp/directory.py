@@ -0,0 +1,182 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import versions
+from .models import User
+
+UserEntry = namedtuple('UserEntry', ['id', 'username', 'is_therapist'])
+
+FIELDS = ('id', 'username', 'is_therapist')
+
+
+class UserDirectory:
+    """
+    Process-local cache of the few user fields the chat needs on hot paths.
+    Entries are evicted least-recently-used once `max_size` is reached and
+    dropped by the User save/delete signals below. Those only fire in the
+    process that saved the user, so every lookup also compares the shared
+    versions.DIRECTORY with the one the cache was filled under and starts
+    over when another worker bumped it.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._by_id = OrderedDict()
+        self._ids = {}  # username -> id
+        self._therapists = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _check_version(self):
+        # Returns the version to pass to the _remember helpers, which drop
+        # rows read under a version that changed while they were queried
+        version, = versions.get(versions.DIRECTORY)
+        with self._lock:
+            if version != self._version:
+                self._by_id.clear()
+                self._ids.clear()
+                self._therapists = None
+                self._version = version
+        return version
+
+    def _remember(self, entry):
+        # Caller holds the lock
+        self._by_id[entry.id] = entry
+        self._by_id.move_to_end(entry.id)
+        self._ids[entry.username] = entry.id
+        while len(self._by_id) > self.max_size:
+            _, old = self._by_id.popitem(last=False)
+            self._ids.pop(old.username, None)
+
+    def _cached(self, username):
+        self._check_version()
+        with self._lock:
+            user_id = self._ids.get(username)
+            if user_id is None:
+                return None
+            self._by_id.move_to_end(user_id)
+            return self._by_id[user_id]
+
+    def get(self, username):
+        entry = self._cached(username)
+        if entry is None:
+            version = self._version
+            row = User.objects.filter(username=username).values_list(*FIELDS).first()
+            if row is None:
+                return None
+            entry = self._remember_rows([row], {}, version)[row[0]]
+        return entry
+
+    async def aget(self, username):
+        # Cache hits never leave the event loop
+        entry = self._cached(username)
+        if entry is None:
+            version = self._version
+            row = await User.objects.filter(username=username).values_list(*FIELDS).afirst()
+            if row is None:
+                return None
+            entry = self._remember_rows([row], {}, version)[row[0]]
+        return entry
+
+    def get_by_id(self, user_id):
+        return self.get_many([user_id]).get(user_id)
+
+    def _cached_many(self, user_ids):
+        version = self._check_version()
+        found, missing = {}, []
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._by_id.get(user_id)
+                if entry is None:
+                    missing.append(user_id)
+                else:
+                    self._by_id.move_to_end(user_id)
+                    found[user_id] = entry
+        return found, missing, version
+
+    def _remember_rows(self, rows, found, version):
+        with self._lock:
+            current = version == self._version
+            for row in rows:
+                entry = UserEntry(*row)
+                if current:
+                    self._remember(entry)
+                found[entry.id] = entry
+        return found
+
+    def get_many(self, user_ids):
+        found, missing, version = self._cached_many(user_ids)
+        if missing:
+            self._remember_rows(User.objects.filter(id__in=missing).values_list(*FIELDS), found, version)
+        return found
+
+    async def aget_many(self, user_ids):
+        found, missing, version = self._cached_many(user_ids)
+        if missing:
+            rows = [row async for row in User.objects.filter(id__in=missing).values_list(*FIELDS)]
+            self._remember_rows(rows, found, version)
+        return found
+
+    def _therapist_rows(self):
+        return User.objects.filter(is_therapist=True).order_by('username').values_list(*FIELDS)
+
+    def _set_therapists(self, rows, version):
+        roster = [UserEntry(*row) for row in rows]
+        with self._lock:
+            if version == self._version:
+                self._therapists = roster
+                for entry in roster:
+                    self._remember(entry)
+        return roster
+
+    def therapists(self):
+        version = self._check_version()
+        roster = self._therapists
+        if roster is None:
+            roster = self._set_therapists(self._therapist_rows(), version)
+        return roster
+
+    async def atherapists(self):
+        version = self._check_version()
+        roster = self._therapists
+        if roster is None:
+            roster = self._set_therapists([row async for row in self._therapist_rows()], version)
+        return roster
+
+    def invalidate(self, user_id):
+        with self._lock:
+            entry = self._by_id.pop(user_id, None)
+            if entry is not None and self._ids.get(entry.username) == user_id:
+                del self._ids[entry.username]
+            self._therapists = None
+
+    def clear(self):
+        with self._lock:
+            self._by_id.clear()
+            self._ids.clear()
+            self._therapists = None
+            self._version = None
+
+
+directory = UserDirectory(max_size=getattr(settings, 'CHAT_USER_CACHE_SIZE', 10000))
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # Logins only touch last_login, which nothing here caches
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    directory.invalidate(instance.id)
+    # After the commit, or another worker could reload the old row
+    transaction.on_commit(lambda: versions.bump(versions.DIRECTORY))
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    directory.invalidate(instance.id)
+    transaction.on_commit(lambda: versions.bump(versions.DIRECTORY))
@@ -0,0 +1,129 @@
+"""
+Streaming message export.
+
+rows() walks one conversation or a user's whole caseload one conversation
+at a time: archived chunks first, then hot messages through
+.iterator(chunk_size), so memory use does not grow with history. Every
+row carries a cursor; passing the last one back as `after` resumes the
+export right after that row.
+"""
+import csv
+import itertools
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+
+from . import history
+from .archive import decode_chunk, pair_messages
+from .directory import directory
+from .models import Conversation, MessageArchive
+
+CHUNK_SIZE = getattr(settings, 'CHAT_EXPORT_CHUNK_SIZE', 2000)
+
+FIELDS = ['cursor', 'id', 'conversation', 'sender', 'receiver', 'timestamp', 'is_read', 'content']
+
+
+# Cursors are "<conversation id>:<history cursor of the last message>"
+def encode_cursor(conversation_id, message):
+    return f'{conversation_id}:{history.encode_cursor(message)}'
+
+
+def decode_cursor(cursor):
+    try:
+        conversation_id, message_cursor = cursor.split(':')
+        return history.check_id(int(conversation_id)), history.decode_cursor(message_cursor)
+    except (AttributeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+def _row(conversation_id, message, sender, receiver):
+    return {
+        'cursor': encode_cursor(conversation_id, message),
+        'id': message.id,
+        'conversation': conversation_id,
+        'sender': sender,
+        'receiver': receiver,
+        'timestamp': message.timestamp.isoformat(),
+        'is_read': message.is_read,
+        'content': message.content,
+    }
+
+
+def conversation_rows(conversation, after=None, chunk_size=CHUNK_SIZE):
+    a, b = conversation.user_a_id, conversation.user_b_id
+    names = {entry.id: entry.username for entry in directory.get_many([a, b]).values()}
+
+    # Archived messages are all older than the hot ones, see chatapp.archive
+    chunks = MessageArchive.objects.filter(user_a_id=a, user_b_id=b)
+    if after:
+        ts, msg_id = after
+        chunks = chunks.filter(Q(last_timestamp__gt=ts) | Q(last_timestamp=ts, last_id__gt=msg_id))
+    for chunk in chunks.order_by('last_timestamp', 'last_id').only('data').iterator(chunk_size=4):
+        for message in decode_chunk(chunk.data):
+            if after and (message.timestamp, message.id) <= after:
+                continue
+            yield _row(conversation.id, message, names.get(message.sender_id), names.get(message.receiver_id))
+
+    messages = pair_messages(a, b).select_related('sender', 'receiver').only(
+        'id', 'timestamp', 'is_read', 'content', 'sender__username', 'receiver__username',
+    )
+    if after:
+        ts, msg_id = after
+        messages = messages.filter(Q(timestamp__gt=ts) | Q(timestamp=ts, id__gt=msg_id))
+    for message in messages.order_by('timestamp', 'id').iterator(chunk_size=chunk_size):
+        yield _row(conversation.id, message, message.sender.username, message.receiver.username)
+
+
+def rows(user, other_user=None, after=None, chunk_size=CHUNK_SIZE):
+    """Yield export rows for user's conversation with other_user, or all of user's conversations."""
+    conversations = Conversation.objects.filter(Q(user_a_id=user.id) | Q(user_b_id=user.id))
+    if other_user is not None:
+        a, b = Conversation.pair(user.id, other_user.id)
+        conversations = conversations.filter(user_a_id=a, user_b_id=b)
+    resume = None
+    if after:
+        conversation_id, resume = decode_cursor(after)
+        conversations = conversations.filter(id__gte=conversation_id)
+    for conversation in conversations.order_by('id').iterator(chunk_size=chunk_size):
+        start = resume if resume and conversation.id == conversation_id else None
+        yield from conversation_rows(conversation, start, chunk_size)
+
+
+def jsonl_lines(rows, header=True):
+    # JSON Lines has no header, the argument is for csv_lines
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+class Echo:
+    # csv.writer needs a file, this one hands each line straight back
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, header=True):
+    writer = csv.DictWriter(Echo(), fieldnames=FIELDS)
+    if header:
+        yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+FORMATS = {
+    'jsonl': (jsonl_lines, 'application/jsonl'),
+    'csv': (csv_lines, 'text/csv'),
+}
+
+
+async def aiter_lines(lines, block=500):
+    # Under ASGI a sync iterator would be read into a list before sending,
+    # so hand the lines over in blocks from the thread that owns the cursor
+    lines = iter(lines)
+    take = sync_to_async(lambda: ''.join(itertools.islice(lines, block)))
+    while True:
+        data = await take()
+        if not data:
+            return
+        yield data
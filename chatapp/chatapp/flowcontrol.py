@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from .metrics import SEND_OVERFLOW, SEND_QUEUED
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('drop', 'coalesce', 'disconnect')
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, and bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def allow(self):
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def reserve(self, cost):
+        """Take `cost` tokens, borrowing if short, and return the seconds to wait until they're earned."""
+        self.refill()
+        self.tokens -= cost
+        return max(0.0, -self.tokens / self.rate)
+
+
+class SendQueue:
+    """
+    Bounded outbound queue for one socket. put() never waits; a task
+    drains the queue into `send`, so a slow reader only ever holds
+    `maxsize` frames. When the queue is full the policy decides:
+
+    drop        the new frame is discarded
+    coalesce    it replaces a queued frame with the same key (a newer read
+                receipt supersedes an older one), otherwise the oldest
+                queued frame is discarded to make room
+    disconnect  put() returns False and the caller closes the socket
+    """
+
+    def __init__(self, send, maxsize, policy):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown send queue policy {policy!r}')
+        self.send = send
+        self.maxsize = maxsize
+        self.policy = policy
+        self._frames = deque()  # [key, frame]
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, key=None):
+        if len(self._frames) >= self.maxsize:
+            if self.policy == 'disconnect':
+                SEND_OVERFLOW.inc(action='disconnect')
+                return False
+            if self.policy == 'drop':
+                SEND_OVERFLOW.inc(action='drop')
+                return True
+            if key is not None:
+                for entry in self._frames:
+                    if entry[0] == key:
+                        entry[1] = frame
+                        SEND_OVERFLOW.inc(action='coalesce')
+                        return True
+            self._frames.popleft()
+            SEND_QUEUED.dec()
+            SEND_OVERFLOW.inc(action='drop')
+
+        self._frames.append([key, frame])
+        SEND_QUEUED.inc()
+        self._ready.set()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return True
+
+    async def _run(self):
+        try:
+            while True:
+                while self._frames:
+                    _, frame = self._frames.popleft()
+                    SEND_QUEUED.dec()
+                    try:
+                        await self.send(frame)
+                    except Exception:
+                        # One bad frame mustn't stall the ones behind it
+                        logger.exception('Sending a queued frame failed')
+                self._ready.clear()
+                await self._ready.wait()
+        finally:
+            # Whatever ended us, the next put() starts a new drain
+            if self._task is asyncio.current_task():
+                self._task = None
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        SEND_QUEUED.dec(len(self._frames))
+        self._frames.clear()
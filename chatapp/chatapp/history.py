@@ -0,0 +1,99 @@
+from datetime import datetime, timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Exists, Q
+from django.urls import reverse
+
+from . import archive
+from .models import Message
+
+PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+
+
+def conversation_messages(user, other_user):
+    return Message.objects.filter(
+        Q(sender_id=user.id, receiver_id=other_user.id) | Q(sender_id=other_user.id, receiver_id=user.id)
+    )
+
+
+# Cursors are "<epoch microseconds>_<message id>" of the oldest message
+# already shown, so the next page is everything strictly before it.
+def encode_cursor(message):
+    ts = message.timestamp
+    micros = int(ts.timestamp()) * 1000000 + ts.microsecond
+    return f'{micros}_{message.id}'
+
+
+# Ids are signed 64 bit in SQLite, anything bigger can't be bound
+MAX_ID = 2 ** 63 - 1
+
+
+def check_id(msg_id):
+    if not -MAX_ID - 1 <= msg_id <= MAX_ID:
+        raise ValueError('Invalid cursor')
+    return msg_id
+
+
+def decode_cursor(cursor):
+    try:
+        micros, msg_id = cursor.split('_')
+        micros, msg_id = int(micros), check_id(int(msg_id))
+        seconds, micro = divmod(micros, 1000000)
+        ts = datetime.fromtimestamp(seconds, tz=timezone.utc).replace(microsecond=micro)
+    except (AttributeError, ValueError, OverflowError, OSError):
+        # A timestamp out of datetime's range overflows
+        raise ValueError('Invalid cursor')
+    return ts, msg_id
+
+
+async def aget_page(user, other_user, before=None, limit=PAGE_SIZE):
+    """Return (messages oldest-first, cursor for the next older page or None)."""
+    # has_archive saves a second query for conversations that fit the hot table
+    messages = conversation_messages(user, other_user).select_related('sender').annotate(
+        has_archive=Exists(archive.pair_chunks(user, other_user)),
+    )
+    boundary = decode_cursor(before) if before else None
+    if boundary:
+        ts, msg_id = boundary
+        messages = messages.filter(Q(timestamp__lt=ts) | Q(timestamp=ts, id__lt=msg_id))
+    page = [message async for message in messages.order_by('-timestamp', '-id')[:limit + 1]]
+    if len(page) <= limit and (not page or page[0].has_archive):
+        # The hot table ran out, carry on into the archive
+        if page:
+            boundary = (page[-1].timestamp, page[-1].id)
+        page += await sync_to_async(archive.messages_before)(user, other_user, boundary, limit + 1 - len(page))
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+    cursor = encode_cursor(page[0]) if has_more else None
+    return page, cursor
+
+
+async def aanchor(msg_id):
+    """Return (timestamp, id) of a hot message, None if it is gone or archived."""
+    if msg_id == 0:
+        # Before the first message, for clients that had none
+        return (datetime.fromtimestamp(0, tz=timezone.utc), 0)
+    timestamp = await Message.objects.filter(id=msg_id).values_list('timestamp', flat=True).afirst()
+    return (timestamp, msg_id) if timestamp is not None else None
+
+
+async def aget_after(user, other_user, after, limit=PAGE_SIZE):
+    """Return up to `limit` messages newer than (timestamp, id) `after`, oldest first."""
+    ts, msg_id = after
+    messages = conversation_messages(user, other_user).select_related('sender').filter(
+        Q(timestamp__gt=ts) | Q(timestamp=ts, id__gt=msg_id)
+    )
+    return [message async for message in messages.order_by('timestamp', 'id')[:limit]]
+
+
+def serialize_message(message):
+    return {
+        'id': message.id,
+        'sender': message.sender.username,
+        'message': message.content,
+        'timestamp': message.timestamp.isoformat(),
+        'is_read': message.is_read,
+        'attachment': reverse('attachment', args=[message.id]) if message.attachment_id else None,
+    }
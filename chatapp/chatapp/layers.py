@@ -0,0 +1,241 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import string
+import struct
+import time
+
+from channels.layers import InMemoryChannelLayer
+
+from .metrics import LAYER_DROPPED
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('!I')
+
+
+# Frames between the hub and the workers are length-prefixed JSON. Channel
+# messages may carry bytes (binary websocket frames), so those are wrapped.
+def _default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f'Cannot send {type(value).__name__} over the channel layer')
+
+
+def _object_hook(value):
+    if len(value) == 1 and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+
+def encode_frame(frame):
+    body = json.dumps(frame, default=_default, separators=(',', ':')).encode()
+    return HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(HEADER.size)
+    (length,) = HEADER.unpack(header)
+    return json.loads(await reader.readexactly(length), object_hook=_object_hook)
+
+
+class ChannelHub:
+    """
+    Routes channel layer traffic between worker processes on one host.
+    Each worker keeps its own sockets in memory and tells the hub which
+    groups it has members in, so group_send only reaches workers that care.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.workers = {}  # worker id -> StreamWriter
+        self.groups = {}  # group -> set of worker ids
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_worker, path=self.path)
+        os.chmod(self.path, 0o600)
+        return self.server
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_worker(self, reader, writer):
+        worker_id = None
+        try:
+            while True:
+                frame = await read_frame(reader)
+                op = frame['op']
+                if op == 'hello':
+                    worker_id = frame['worker']
+                    self.workers[worker_id] = writer
+                elif op == 'join':
+                    self.groups.setdefault(frame['group'], set()).add(worker_id)
+                elif op == 'leave':
+                    self.leave(frame['group'], worker_id)
+                elif op == 'group_send':
+                    for other in self.groups.get(frame['group'], ()):
+                        if other != worker_id:
+                            self.forward(other, frame)
+                elif op == 'send':
+                    self.forward(frame['worker'], frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if worker_id is not None:
+                self.workers.pop(worker_id, None)
+                for group in list(self.groups):
+                    self.leave(group, worker_id)
+            writer.close()
+
+    def leave(self, group, worker_id):
+        members = self.groups.get(group)
+        if members is not None:
+            members.discard(worker_id)
+            if not members:
+                del self.groups[group]
+
+    def forward(self, worker_id, frame):
+        writer = self.workers.get(worker_id)
+        if writer is not None and not writer.is_closing():
+            writer.write(encode_frame(frame))
+
+
+class UnixSocketChannelLayer(InMemoryChannelLayer):
+    """
+    InMemoryChannelLayer that also reaches channels held by other worker
+    processes through a ChannelHub listening on a Unix domain socket.
+    Without a reachable hub it behaves like the in-memory layer.
+    """
+
+    def __init__(self, path, reconnect_interval=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.reconnect_interval = reconnect_interval
+        self.worker_id = ''.join(random.choice(string.ascii_letters) for _ in range(8))
+        self._loop = None
+        self._writer = None
+        self._connecting = None
+        self._last_attempt = 0
+        self._warned_drop = False  # since the last connection attempt
+
+    async def new_channel(self, prefix='specific.'):
+        return '%s.%s!%s' % (
+            prefix,
+            self.worker_id,
+            ''.join(random.choice(string.ascii_letters) for _ in range(12)),
+        )
+
+    def _owner(self, channel):
+        # "specific..<worker>!<random>" -> worker id, None for other names
+        if '!' not in channel:
+            return None
+        return channel.split('!', 1)[0].rsplit('.', 1)[-1]
+
+    # Hub connection
+
+    async def _hub(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._writer, self._connecting = loop, None, None
+        if self._writer is not None and not self._writer.is_closing():
+            return self._writer
+        if self._connecting is None:
+            if time.monotonic() - self._last_attempt < self.reconnect_interval:
+                return None
+            self._connecting = loop.create_task(self._connect())
+        try:
+            return await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+
+    async def _connect(self):
+        self._last_attempt = time.monotonic()
+        self._warned_drop = False
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        except OSError as exc:
+            logger.warning('Channel hub at %s unavailable (%s), delivering locally only', self.path, exc)
+            return None
+        writer.write(encode_frame({'op': 'hello', 'worker': self.worker_id}))
+        for group in self.groups:
+            writer.write(encode_frame({'op': 'join', 'group': group}))
+        self._writer = writer
+        asyncio.get_running_loop().create_task(self._read_hub(reader, writer))
+        return writer
+
+    async def _read_hub(self, reader, writer):
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame['op'] == 'group_send':
+                    await super().group_send(frame['group'], frame['message'])
+                elif frame['op'] == 'send':
+                    await self._send_local(frame['channel'], frame['message'])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning('Lost connection to channel hub at %s', self.path)
+        finally:
+            if self._writer is writer:
+                self._writer = None
+            writer.close()
+
+    async def _publish(self, frame):
+        writer = await self._hub()
+        if writer is not None:
+            writer.write(encode_frame(frame))
+        elif frame['op'] in ('send', 'group_send'):
+            # Joins are sent again on reconnect, messages are lost. Warned
+            # once per reconnect attempt, the counter has the full count.
+            LAYER_DROPPED.inc(op=frame['op'])
+            if not self._warned_drop:
+                self._warned_drop = True
+                logger.warning('Channel hub at %s unreachable, dropping messages for other workers', self.path)
+
+    # Channel layer API
+
+    async def _send_local(self, channel, message):
+        try:
+            await super().send(channel, message)
+        except Exception:
+            # Full or expired channels drop messages, like group_send does
+            pass
+
+    async def send(self, channel, message):
+        owner = self._owner(channel)
+        if owner is None or owner == self.worker_id:
+            await super().send(channel, message)
+        else:
+            self.require_valid_channel_name(channel)
+            await self._publish({'op': 'send', 'worker': owner, 'channel': channel, 'message': message})
+
+    async def group_add(self, group, channel):
+        first = group not in self.groups
+        await super().group_add(group, channel)
+        if first:
+            await self._publish({'op': 'join', 'group': group})
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        if group not in self.groups:
+            await self._publish({'op': 'leave', 'group': group})
+
+    async def group_send(self, group, message):
+        await super().group_send(group, message)
+        await self._publish({'op': 'group_send', 'group': group, 'message': message})
+
+    async def flush(self):
+        await super().flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def close(self):
+        await self.flush()
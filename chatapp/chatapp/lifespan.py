@@ -0,0 +1,38 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Coroutine functions run when the ASGI server starts and stops
+startup_hooks = []
+shutdown_hooks = []
+
+
+def on_shutdown(func):
+    shutdown_hooks.append(func)
+    return func
+
+
+def on_startup(func):
+    startup_hooks.append(func)
+    return func
+
+
+async def _run(hooks):
+    for hook in hooks:
+        try:
+            await hook()
+        except Exception:
+            logger.exception('Lifespan hook %s failed', hook.__name__)
+
+
+async def application(scope, receive, send):
+    # Handles the ASGI "lifespan" scope for uvicorn
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            await _run(startup_hooks)
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            await _run(shutdown_hooks)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
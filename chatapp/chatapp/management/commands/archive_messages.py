@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from chatapp import archive
+
+
+class Command(BaseCommand):
+    help = 'Move read messages older than the cutoff into the compressed message archive.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=archive.AFTER_DAYS, help='Archive messages older than this many days.')
+        parser.add_argument('--chunk-size', type=int, default=archive.CHUNK_SIZE, help='Messages per archive chunk.')
+
+    def handle(self, *args, **options):
+        moved = archive.archive_old_messages(days=options['days'], chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {moved} messages'))
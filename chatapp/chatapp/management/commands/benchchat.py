@@ -0,0 +1,58 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from chatapp import bench
+
+
+class Command(BaseCommand):
+    help = 'Load-test ChatConsumer and report delivery latency, throughput and memory per connection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pairs', type=int, default=100, help='Concurrent client/therapist pairs.')
+        parser.add_argument('--messages', type=int, default=10, help='Messages each client sends.')
+        parser.add_argument('--rate', type=float, default=5.0, help='Messages per second per client, 0 for as fast as possible.')
+        parser.add_argument('--url', help='ws://host:port of a running server, in-process when omitted.')
+        parser.add_argument('--output', help='Write the JSON report to this file.')
+        parser.add_argument('--baseline', help='Compare against a previous JSON report.')
+        parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed regression against the baseline (0.10 = 10%%).')
+        parser.add_argument('--keep-data', action='store_true', help='Keep the bench_ users and their messages.')
+        parser.add_argument('--write-behind', action='store_true', help='Run with CHAT_WRITE_BEHIND enabled.')
+        parser.add_argument('--http', action='store_true', help='Load the inbox and room pages instead of the socket.')
+        parser.add_argument('--rounds', type=int, default=10, help='With --http, page loads per user (inbox and room each).')
+
+    def handle(self, *args, **options):
+        if options['http']:
+            report = bench.run_http(
+                pairs=options['pairs'],
+                rounds=options['rounds'],
+                keep_data=options['keep_data'],
+            )
+        else:
+            with override_settings(CHAT_WRITE_BEHIND=options['write_behind'] or settings.CHAT_WRITE_BEHIND):
+                report = bench.run(
+                    pairs=options['pairs'],
+                    messages=options['messages'],
+                    rate=options['rate'],
+                    url=options['url'],
+                    keep_data=options['keep_data'],
+                )
+        text = json.dumps(report, indent=2)
+        self.stdout.write(text)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(text + '\n')
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressed = []
+            for key, old, new, change, worse in bench.compare(report, baseline, options['tolerance']):
+                line = f'{key:32} {old:>12.2f} -> {new:>12.2f} ({change:+.1%})'
+                self.stdout.write(self.style.ERROR(line) if worse else line)
+                if worse:
+                    regressed.append(key)
+            if regressed:
+                raise CommandError(f'Regressed against baseline: {", ".join(regressed)}')
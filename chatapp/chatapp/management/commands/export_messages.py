@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatapp import export
+from chatapp.directory import directory
+
+
+class Command(BaseCommand):
+    help = "Stream a user's conversations (or one of them) as JSON Lines or CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument('user', help='Username whose conversations to export.')
+        parser.add_argument('--with', dest='other', help='Only the conversation with this username.')
+        parser.add_argument('--format', choices=sorted(export.FORMATS), default='jsonl')
+        parser.add_argument('--after', help='Resume after this cursor (the last exported row\'s "cursor").')
+        parser.add_argument('--output', help='Write to this file instead of stdout (appends when resuming).')
+
+    def handle(self, *args, **options):
+        user = directory.get(options['user'])
+        if user is None:
+            raise CommandError(f"No user {options['user']!r}")
+        other_user = None
+        if options['other']:
+            other_user = directory.get(options['other'])
+            if other_user is None:
+                raise CommandError(f"No user {options['other']!r}")
+        if options['after']:
+            try:
+                export.decode_cursor(options['after'])
+            except ValueError as exc:
+                raise CommandError(exc)
+
+        to_lines, _ = export.FORMATS[options['format']]
+        lines = to_lines(export.rows(user, other_user, options['after']), header=not options['after'])
+        if options['output']:
+            with open(options['output'], 'a' if options['after'] else 'w', newline='') as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chatapp import archive, search
+
+
+class Command(BaseCommand):
+    help = 'Create the message full-text indexes and their triggers if missing, then rebuild them from chatapp_message and the archive.'
+
+    def handle(self, *args, **options):
+        search.install(rebuild=True)
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO chatapp_message_fts(chatapp_message_fts) VALUES ('optimize')")
+            cursor.execute('SELECT count(*) FROM chatapp_message')
+            (count,) = cursor.fetchone()
+        archived = archive.reindex()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} messages and {archived} archived ones'))
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatapp.layers import ChannelHub
+
+
+class Command(BaseCommand):
+    help = 'Run core.asgi.application in several uvicorn worker processes sharing one channel layer hub.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8000)
+        parser.add_argument(
+            '--socket',
+            default=os.path.join(tempfile.gettempdir(), f'chatapp-layer-{os.getpid()}.sock'),
+            help='Unix socket path for the channel layer hub.',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            import uvicorn
+        except ImportError:
+            raise CommandError('uvicorn is required, install it with "pip install uvicorn"')
+
+        path = options['socket']
+        hub = ChannelHub(path)
+        ready = threading.Event()
+
+        def run_hub():
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(hub.start())
+            ready.set()
+            loop.run_forever()
+
+        threading.Thread(target=run_hub, name='channel-hub', daemon=True).start()
+        ready.wait()
+        self.stdout.write(f'Channel hub listening on {path}')
+
+        # Worker processes pick the socket layer up from settings
+        os.environ['CHAT_LAYER_SOCKET'] = path
+        try:
+            uvicorn.run(
+                'core.asgi:application',
+                host=options['host'],
+                port=options['port'],
+                workers=options['workers'],
+                lifespan='on',
+                # Refuse oversized frames before they are even read.
+                # Attachment chunks carry an 8 byte offset.
+                ws_max_size=max(settings.CHAT_MAX_FRAME_BYTES, settings.CHAT_ATTACHMENT_CHUNK_BYTES + 8),
+            )
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
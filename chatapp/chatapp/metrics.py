@@ -0,0 +1,289 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import secrets
+import sys
+import threading
+import time
+from collections import Counter as Tally
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _label_text(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{self._label_text(key)} {value}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # per-bucket counts, then +Inf, then the running sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def _render_value(self, key, counts):
+        lines, total = [], 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            total += count
+            lines.append(f'{self.name}_bucket{self._label_text(key, ("le", bound))} {total}')
+        lines.append(f'{self.name}_sum{self._label_text(key)} {counts[-1]}')
+        lines.append(f'{self.name}_count{self._label_text(key)} {total}')
+        return lines
+
+
+registry = []
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Chat socket metrics
+CONNECTIONS = Gauge('chat_connections', 'Open chat websockets in this process.')
+FRAMES = Counter('chat_frames_received_total', 'Websocket frames received, by frame type.', ['type'])
+RECEIVE_SECONDS = Histogram('chat_receive_seconds', 'Time spent handling a chat message, by phase.', ['phase'])
+FANOUT = Histogram('chat_room_fanout', 'Local sockets in the room when a message is broadcast.', buckets=(1, 2, 3, 4, 8, 16, 64))
+TYPING_EVENTS = Counter('chat_typing_events_total', 'Typing indicator changes broadcast to rooms.')
+UPLOAD_BYTES = Counter('chat_upload_bytes_total', 'Attachment bytes received over chat sockets.')
+UPLOAD_THROTTLED = Counter('chat_upload_throttled_seconds_total', 'Time chunk frames were held back by the per-socket upload budget.')
+RATE_LIMITED = Counter('chat_frames_rate_limited_total', 'Inbound frames rejected by the per-socket rate limit.')
+FRAMES_TOO_LARGE = Counter('chat_frames_too_large_total', 'Sockets closed for sending a frame over CHAT_MAX_FRAME_BYTES.')
+SEND_QUEUED = Gauge('chat_send_queue_frames', 'Outbound frames waiting in send queues.')
+SEND_OVERFLOW = Counter('chat_send_queue_overflow_total', 'Outbound frames that hit a full send queue, by what happened to them.', ['action'])
+BATCH_EVENTS = Histogram('chat_batch_events', 'Events per batched frame sent to protocol v2 sockets.', buckets=(1, 2, 5, 10, 25, 50, 100))
+LAYER_DROPPED = Counter('chat_layer_dropped_total', 'Channel layer messages for other workers dropped while the hub was unreachable.', ['op'])
+REPLAYED = Counter('chat_replayed_messages_total', 'Messages replayed to reconnecting sockets.')
+THREAD_WAIT = Histogram('chat_sync_to_async_wait_seconds', 'Time sync_to_async calls spend waiting for the thread, excluding the call itself.')
+WRITE_BATCH = Histogram('chat_db_write_batch', 'Operations committed together by the DB writer thread.', buckets=(1, 2, 5, 10, 25, 50, 100, 200))
+WRITE_QUEUE_WAIT = Histogram('chat_db_write_queue_seconds', 'Time writes wait in the DB writer queue.')
+
+# View metrics
+VIEW_SECONDS = Histogram('chat_view_seconds', 'View latency.', ['view'])
+VIEW_QUERIES = Histogram('chat_view_queries', 'Database queries per view call.', ['view'], buckets=(1, 2, 3, 5, 8, 13, 21, 50, 100))
+
+
+def timed_sync_to_async(func):
+    """sync_to_async that also records how long the call waited for its thread."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        inner = 0.0
+
+        def call():
+            nonlocal inner
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                inner = time.perf_counter() - started
+
+        started = time.perf_counter()
+        result = await sync_to_async(call)()
+        THREAD_WAIT.observe(time.perf_counter() - started - inner)
+        return result
+    return wrapper
+
+
+# Queries run by the current view call. A context variable rather than
+# connection.execute_wrapper(), because an async view's queries run on
+# sync_to_async threads, each with its own connection; sync_to_async copies
+# the context there, so every connection can count for the right view.
+view_queries = contextvars.ContextVar('view_queries', default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    counter = view_queries.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    # First in the list: execute_wrapper() blocks pop the last one, and a
+    # connection can be opened inside one of them
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, count_query)
+
+
+class Sampler(threading.Thread):
+    """Samples the stacks of some threads every `interval` seconds."""
+
+    def __init__(self, thread_ids, interval):
+        super().__init__(daemon=True)
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.stacks = Tally()
+        self.finished = threading.Event()
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in self.thread_ids:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[';'.join(reversed(stack))] += 1
+
+    def report(self):
+        # Collapsed stacks, the input format of flamegraph.pl / speedscope
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common()) + '\n'
+
+
+def profiling_asked(request):
+    return getattr(settings, 'CHAT_PROFILER_ENABLED', False) and request.GET.get('profile') == '1'
+
+
+def profiling_requested(request):
+    return profiling_asked(request) and request.user.is_staff
+
+
+def instrument_view(view):
+    """Record latency and query count for a view; ?profile=1 samples it instead."""
+    name = view.__name__
+
+    def finish(response, started, counter, sampler):
+        VIEW_SECONDS.observe(time.perf_counter() - started, view=name)
+        VIEW_QUERIES.observe(counter[0], view=name)
+        if sampler is not None:
+            return HttpResponse(sampler.report(), content_type='text/plain')
+        return response
+
+    def start_sampler(thread_ids):
+        sampler = Sampler(thread_ids, getattr(settings, 'CHAT_PROFILER_INTERVAL', 0.001))
+        sampler.start()
+        return sampler
+
+    def stop_sampler(sampler):
+        if sampler is not None:
+            sampler.finished.set()
+            sampler.join()
+
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            counter = [0]
+            token = view_queries.set(counter)
+            sampler = None
+            if profiling_asked(request) and (await request.auser()).is_staff:
+                # The event loop, and the thread this request's
+                # sync_to_async calls (the ORM among them) run on
+                sync_thread = await sync_to_async(threading.get_ident)()
+                sampler = start_sampler([threading.get_ident(), sync_thread])
+            started = time.perf_counter()
+            try:
+                response = await view(request, *args, **kwargs)
+            finally:
+                view_queries.reset(token)
+                stop_sampler(sampler)
+            return finish(response, started, counter, sampler)
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        counter = [0]
+        token = view_queries.set(counter)
+        sampler = None
+        if profiling_requested(request):
+            sampler = start_sampler([threading.get_ident()])
+        started = time.perf_counter()
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            view_queries.reset(token)
+            stop_sampler(sampler)
+        return finish(response, started, counter, sampler)
+    return wrapper
+
+
+def metrics_allowed(request):
+    token = getattr(settings, 'CHAT_METRICS_TOKEN', '')
+    given = request.META.get('HTTP_AUTHORIZATION', '').encode()
+    if token and secrets.compare_digest(given, f'Bearer {token}'.encode()):
+        return True
+    if request.META.get('REMOTE_ADDR') in getattr(settings, 'CHAT_METRICS_ALLOWED_IPS', ()):
+        return True
+    return request.user.is_staff
+
+
+def metrics_view(request):
+    if not metrics_allowed(request):
+        return HttpResponse(status=403)
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
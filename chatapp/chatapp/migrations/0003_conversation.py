@@ -0,0 +1,50 @@
+# Generated by Django 5.2.4 on 2026-10-16 22:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_conversations(apps, schema_editor):
+    Message = apps.get_model('chatapp', 'Message')
+    Conversation = apps.get_model('chatapp', 'Conversation')
+    conversations = {}
+    for msg in Message.objects.order_by('timestamp', 'id').iterator():
+        a, b = sorted((msg.sender_id, msg.receiver_id))
+        conv = conversations.get((a, b))
+        if conv is None:
+            conv = conversations[(a, b)] = Conversation(user_a_id=a, user_b_id=b)
+        conv.last_message_id = msg.id
+        conv.last_timestamp = msg.timestamp
+        if not msg.is_read:
+            if msg.receiver_id == a:
+                conv.unread_a += 1
+            else:
+                conv.unread_b += 1
+    Conversation.objects.bulk_create(conversations.values())
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0002_message_is_read'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('unread_a', models.PositiveIntegerField(default=0)),
+                ('unread_b', models.PositiveIntegerField(default=0)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chatapp.message')),
+                ('user_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_a', '-last_timestamp'], name='conversation_a_recent_idx'), models.Index(fields=['user_b', '-last_timestamp'], name='conversation_b_recent_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user_a', 'user_b'), name='conversation_pair_unique')],
+            },
+        ),
+        migrations.RunPython(build_conversations, migrations.RunPython.noop),
+    ]
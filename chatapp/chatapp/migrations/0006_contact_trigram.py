@@ -0,0 +1,38 @@
+# Generated by Django 5.2.4 on 2026-10-16 22:35
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def index_users(apps, schema_editor):
+    User = apps.get_model('chatapp', 'User')
+    ContactTrigram = apps.get_model('chatapp', 'ContactTrigram')
+    rows = []
+    for user_id, username in User.objects.values_list('id', 'username').iterator():
+        padded = f'  {username.lower()} '
+        grams = {padded[i:i + 3] for i in range(len(padded) - 2)}
+        rows.extend(ContactTrigram(user_id=user_id, gram=gram) for gram in grams)
+    ContactTrigram.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0005_message_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(max_length=3)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('gram', 'user'), name='contact_trigram_unique')],
+            },
+        ),
+        migrations.RunPython(index_users, migrations.RunPython.noop),
+    ]
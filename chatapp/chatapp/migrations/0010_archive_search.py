@@ -0,0 +1,38 @@
+from django.db import migrations
+
+from chatapp.archive import decode_rows
+from chatapp.search import ARCHIVE_CREATE_SQL, ARCHIVE_DROP_SQL, INDEX_ARCHIVED_SQL
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in ARCHIVE_CREATE_SQL:
+        schema_editor.execute(sql)
+    # Index what was archived before the index existed
+    MessageArchive = apps.get_model('chatapp', 'MessageArchive')
+    ops = schema_editor.connection.ops
+    with schema_editor.connection.cursor() as cursor:
+        for chunk in MessageArchive.objects.only('data').iterator(chunk_size=4):
+            cursor.executemany(INDEX_ARCHIVED_SQL, [
+                (row['id'], row['content'], row['sender_id'], row['receiver_id'], ops.adapt_datetimefield_value(row['timestamp']))
+                for row in decode_rows(chunk.data)
+            ])
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in ARCHIVE_DROP_SQL:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0009_attachment'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
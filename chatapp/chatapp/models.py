@@ -1,5 +1,9 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+
+from . import versions
 
 
 class User(AbstractUser):
@@ -9,15 +13,180 @@ class User(AbstractUser):
         return self.username
 
 
+class Attachment(models.Model):
+    # Content addressed: one row and one file per distinct sha256, however
+    # many messages share it, see chatapp.attachments
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.size} bytes)"
+
+
 class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
+    # For attachments content holds the file name, so previews and search
+    # still work. No index: nothing looks messages up by attachment.
+    attachment = models.ForeignKey(
+        Attachment, null=True, blank=True, on_delete=models.PROTECT, related_name='+', db_index=False,
+    )
+
+    class Meta:
+        indexes = [
+            # Conversation history, newest first (chat_view / chat_history)
+            models.Index(fields=['sender', 'receiver', 'timestamp', 'id'], name='message_pair_time_idx'),
+            # Unread rows only, for mark-read and unread counts
+            models.Index(
+                fields=['receiver', 'sender'],
+                condition=Q(is_read=False),
+                name='message_unread_idx',
+            ),
+            # Newest first across everyone, for the admin changelist and its date filter
+            models.Index(fields=['timestamp'], name='message_time_idx'),
+        ]
 
-    
     def __str__(self):
         return f"From {self.sender} to {self.receiver}: {self.content[:20]}"
 
 
+class Conversation(models.Model):
+    # One row per user pair, user_a always has the lower id.
+    # Kept up to date by the consumer and chat_view so the inbox never
+    # has to aggregate over Message.
+    user_a = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    user_b = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    last_message = models.ForeignKey(Message, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    last_timestamp = models.DateTimeField(null=True, blank=True)
+    unread_a = models.PositiveIntegerField(default=0)  # unread by user_a
+    unread_b = models.PositiveIntegerField(default=0)  # unread by user_b
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_a', 'user_b'], name='conversation_pair_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['user_a', '-last_timestamp'], name='conversation_a_recent_idx'),
+            models.Index(fields=['user_b', '-last_timestamp'], name='conversation_b_recent_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_a_id} <-> {self.user_b_id}"
+
+    @staticmethod
+    def pair(user_id, other_id):
+        return (user_id, other_id) if user_id < other_id else (other_id, user_id)
+
+    @classmethod
+    def for_user(cls, user):
+        return cls.objects.filter(Q(user_a=user) | Q(user_b=user))
+
+    def other_user(self, user):
+        return self.user_b if self.user_a_id == user.id else self.user_a
+
+    def other_id(self, user):
+        return self.user_b_id if self.user_a_id == user.id else self.user_a_id
+
+    def unread_for(self, user):
+        return self.unread_a if self.user_a_id == user.id else self.unread_b
+
+    @classmethod
+    def record_message(cls, message):
+        return cls.record_messages([message])[0]
+
+    @classmethod
+    def record_messages(cls, messages):
+        # Fold a batch of saved messages into one update per pair
+        pairs = {}
+        for message in messages:
+            a, b = cls.pair(message.sender_id, message.receiver_id)
+            entry = pairs.setdefault((a, b), {'last': message, 'unread_a': 0, 'unread_b': 0})
+            entry['last'] = message
+            if not message.is_read:
+                entry['unread_a' if message.receiver_id == a else 'unread_b'] += 1
+
+        conversations = []
+        with transaction.atomic():
+            for (a, b), entry in pairs.items():
+                last = entry['last']
+                conversation, created = cls.objects.get_or_create(
+                    user_a_id=a, user_b_id=b,
+                    defaults={
+                        'last_message': last,
+                        'last_timestamp': last.timestamp,
+                        'unread_a': entry['unread_a'],
+                        'unread_b': entry['unread_b'],
+                    },
+                )
+                if not created:
+                    cls.objects.filter(pk=conversation.pk).update(
+                        last_message=last,
+                        last_timestamp=last.timestamp,
+                        unread_a=F('unread_a') + entry['unread_a'],
+                        unread_b=F('unread_b') + entry['unread_b'],
+                    )
+                conversation.created = created  # lets callers announce new conversations
+                conversations.append(conversation)
+                transaction.on_commit(lambda a=a, b=b: versions.bump_conversation(a, b))
+        return conversations
+
+    @classmethod
+    def mark_read(cls, reader, other, count=None):
+        # count=None resets the counter, otherwise it drops by count
+        a, b = cls.pair(reader.id, other.id)
+        unread_field = 'unread_a' if reader.id == a else 'unread_b'
+        value = 0 if count is None else Greatest(F(unread_field) - count, 0)
+        cls.objects.filter(user_a_id=a, user_b_id=b).update(**{unread_field: value})
+
+    @classmethod
+    def acknowledge(cls, reader, other, upto=None):
+        # Mark messages from other up to id `upto` (or all of them) as read
+        unread = Message.objects.filter(sender_id=other.id, receiver_id=reader.id, is_read=False)
+        if upto is not None:
+            unread = unread.filter(id__lte=upto)
+        with transaction.atomic():
+            count = unread.update(is_read=True)
+            if count:
+                cls.mark_read(reader, other, count)
+                transaction.on_commit(lambda: versions.bump_conversation(reader.id, other.id))
+        return count
+
+
+class MessageArchive(models.Model):
+    # Append-only cold storage, see chatapp.archive. Each row is a zlib
+    # compressed chunk of one conversation's messages as JSON lines, and
+    # always older than anything of that pair still in Message.
+    user_a = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    user_b = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    first_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_id = models.BigIntegerField()
+    last_timestamp = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_a', 'user_b', '-last_timestamp', '-last_id'], name='archive_pair_recent_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_a_id} <-> {self.user_b_id}: {self.count} messages"
+
+
+class ContactTrigram(models.Model):
+    # Padded lowercase trigrams of each username, see chatapp.contact_search
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    gram = models.CharField(max_length=3)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['gram', 'user'], name='contact_trigram_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.gram!r} -> {self.user_id}"
@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def _key(user_id):
+    return f'chat:presence:{user_id}'
+
+
+class PresenceRegistry:
+    """
+    Who has an open socket, across every worker process.
+
+    Each process counts its own sockets per user, so a second tab closing
+    does not mark the user offline, and publishes in the shared cache how
+    long each of its users counts as online: {worker: until}, in wall clock
+    seconds. Heartbeats push `until` out again, but only once it is less
+    than half the ttl away, so the cache is written every ttl/2 seconds
+    per user at most. Expiry only hides the user, their sockets are still
+    counted, and the next heartbeat from any of them brings them back.
+
+    Two workers publishing the same user at once can lose one entry (the
+    cache has no compare-and-set); that worker puts it back on its next
+    heartbeat publish, so the user can look offline for up to ttl/2.
+    """
+
+    def __init__(self, ttl, worker=None):
+        self.ttl = ttl
+        self.worker = worker or str(os.getpid())
+        self._connections = {}  # user id -> open sockets in this process
+        self._until = {}  # user id -> until we last published
+        self._lock = threading.Lock()
+
+    def _publish(self, user_id, until):
+        # Under the lock, so this process's writes for a user land in order
+        key = _key(user_id)
+        workers = cache.get(key) or {}
+        now = time.time()
+        workers = {worker: seen for worker, seen in workers.items() if seen > now}
+        if until is None:
+            workers.pop(self.worker, None)
+        else:
+            workers[self.worker] = until
+        if workers:
+            cache.set(key, workers, self.ttl)
+        else:
+            cache.delete(key)
+
+    def connect(self, user_id):
+        with self._lock:
+            self._connections[user_id] = self._connections.get(user_id, 0) + 1
+            # Always written, in case the cache dropped the entry
+            self._touch(user_id, force=True)
+
+    def disconnect(self, user_id):
+        with self._lock:
+            count = self._connections.get(user_id, 0) - 1
+            if count > 0:
+                self._connections[user_id] = count
+                return
+            self._connections.pop(user_id, None)
+            self._until.pop(user_id, None)
+            self._publish(user_id, None)
+
+    def heartbeat(self, user_id):
+        with self._lock:
+            if user_id in self._connections:
+                self._touch(user_id)
+
+    def _touch(self, user_id, force=False):
+        now = time.time()
+        if force or self._until.get(user_id, 0) - now < self.ttl / 2:
+            self._until[user_id] = now + self.ttl
+            self._publish(user_id, now + self.ttl)
+
+    def is_online(self, user_id):
+        return user_id in self.online([user_id])
+
+    def online(self, user_ids):
+        keys = {_key(user_id): user_id for user_id in user_ids}
+        now = time.time()
+        return {
+            keys[key] for key, workers in cache.get_many(keys).items()
+            if any(until > now for until in workers.values())
+        }
+
+
+HEARTBEAT_INTERVAL = getattr(settings, 'CHAT_PRESENCE_HEARTBEAT', 25)
+
+presence = PresenceRegistry(ttl=getattr(settings, 'CHAT_PRESENCE_TTL', 60))
@@ -3,5 +3,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<username>\w+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/notify/$', consumers.NotifyConsumer.as_asgi()),
 ]
 #NOT SURE OF WHAT I UPDATED
\ No newline at end of file
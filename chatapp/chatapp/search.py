@@ -0,0 +1,174 @@
+import re
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.html import escape
+
+PAGE_SIZE = getattr(settings, 'CHAT_SEARCH_PAGE_SIZE', 20)
+
+# FTS5 index over Message.content, kept in sync by triggers. External
+# content (content='chatapp_message') means the text is not stored twice.
+# SQLite drops triggers when Django rebuilds chatapp_message during a
+# migration, so install() is safe to run again at any time.
+#
+# Archived messages leave chatapp_message, and the delete trigger takes
+# them out of that index, so chatapp.archive adds them to a second index
+# that keeps its own copy of the text (the chunks are compressed, SQL
+# can't read them). Deleting a chunk drops its messages from it again.
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chatapp_message_fts USING fts5(
+        content, content='chatapp_message', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chatapp_message_fts_insert AFTER INSERT ON chatapp_message BEGIN
+        INSERT INTO chatapp_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chatapp_message_fts_delete AFTER DELETE ON chatapp_message BEGIN
+        INSERT INTO chatapp_message_fts(chatapp_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chatapp_message_fts_update AFTER UPDATE OF content ON chatapp_message BEGIN
+        INSERT INTO chatapp_message_fts(chatapp_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chatapp_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+# Separate, the 0005 migration that creates the index above runs before
+# chatapp_messagearchive exists
+ARCHIVE_CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chatapp_archive_fts USING fts5(
+        content, sender_id UNINDEXED, receiver_id UNINDEXED, timestamp UNINDEXED,
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chatapp_archive_fts_delete AFTER DELETE ON chatapp_messagearchive BEGIN
+        DELETE FROM chatapp_archive_fts WHERE rowid BETWEEN old.first_id AND old.last_id
+            AND sender_id IN (old.user_a_id, old.user_b_id) AND receiver_id IN (old.user_a_id, old.user_b_id);
+    END
+    """,
+]
+
+REBUILD_SQL = "INSERT INTO chatapp_message_fts(chatapp_message_fts) VALUES ('rebuild')"
+
+DROP_SQL = [
+    'DROP TRIGGER IF EXISTS chatapp_message_fts_insert',
+    'DROP TRIGGER IF EXISTS chatapp_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chatapp_message_fts_update',
+    'DROP TABLE IF EXISTS chatapp_message_fts',
+]
+
+ARCHIVE_DROP_SQL = [
+    'DROP TRIGGER IF EXISTS chatapp_archive_fts_delete',
+    'DROP TABLE IF EXISTS chatapp_archive_fts',
+]
+
+INDEX_ARCHIVED_SQL = """
+    INSERT INTO chatapp_archive_fts(rowid, content, sender_id, receiver_id, timestamp) VALUES (%s, %s, %s, %s, %s)
+"""
+
+# bm25 scores from the two indexes are close enough to sort together,
+# though each is weighted by the statistics of its own index
+
+SEARCH_SQL = """
+    SELECT id, sender_id, receiver_id, timestamp, snippet, rank FROM (
+        SELECT m.id, m.sender_id, m.receiver_id, m.timestamp,
+               snippet(chatapp_message_fts, 0, char(2), char(3), '…', 12) AS snippet,
+               bm25(chatapp_message_fts) AS rank
+        FROM chatapp_message_fts
+        JOIN chatapp_message m ON m.id = chatapp_message_fts.rowid
+        WHERE chatapp_message_fts MATCH %s AND (m.sender_id = %s OR m.receiver_id = %s)
+        UNION ALL
+        SELECT rowid, sender_id, receiver_id, timestamp,
+               snippet(chatapp_archive_fts, 0, char(2), char(3), '…', 12),
+               bm25(chatapp_archive_fts)
+        FROM chatapp_archive_fts
+        WHERE chatapp_archive_fts MATCH %s AND (sender_id = %s OR receiver_id = %s)
+    )
+    WHERE rank > %s OR (rank = %s AND id > %s)
+    ORDER BY rank, id
+    LIMIT %s
+"""
+
+
+def install(rebuild=True):
+    with connection.cursor() as cursor:
+        for sql in CREATE_SQL + ARCHIVE_CREATE_SQL:
+            cursor.execute(sql)
+        if rebuild:
+            cursor.execute(REBUILD_SQL)
+
+
+def index_archived(messages):
+    """Add archived messages to the archive index, see chatapp.archive."""
+    with connection.cursor() as cursor:
+        cursor.executemany(INDEX_ARCHIVED_SQL, [
+            (
+                message['id'], message['content'], message['sender_id'], message['receiver_id'],
+                connection.ops.adapt_datetimefield_value(message['timestamp']),
+            )
+            for message in messages
+        ])
+
+
+def match_expression(query):
+    # Quote every word so user input can never be read as FTS5 syntax,
+    # and prefix-match them so "anx" finds "anxiety"
+    words = re.findall(r'\w+', query)
+    return ' '.join(f'"{word}"*' for word in words) or None
+
+
+def encode_cursor(rank, msg_id):
+    return f'{rank!r}_{msg_id}'
+
+
+def decode_cursor(cursor):
+    try:
+        rank, msg_id = cursor.rsplit('_', 1)
+        rank, msg_id = float(rank), int(msg_id)
+    except (AttributeError, ValueError):
+        raise ValueError('Invalid cursor')
+    # SQLite can't bind ids past signed 64 bit
+    if not -2 ** 63 <= msg_id < 2 ** 63:
+        raise ValueError('Invalid cursor')
+    return rank, msg_id
+
+
+def highlight(snippet):
+    return escape(snippet).replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+
+def search(user, query, after=None, limit=PAGE_SIZE):
+    """Return (rows best match first, cursor for the next page or None)."""
+    expression = match_expression(query)
+    if expression is None:
+        return [], None
+    rank, msg_id = decode_cursor(after) if after else (float('-inf'), 0)
+    with connection.cursor() as cursor:
+        cursor.execute(SEARCH_SQL, [expression, user.id, user.id, expression, user.id, user.id, rank, rank, msg_id, limit + 1])
+        columns = [col[0] for col in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['rank'], rows[-1]['id'])
+    for row in rows:
+        row['snippet'] = highlight(row['snippet'])
+        # Raw cursors hand back naive UTC datetimes on SQLite, or the
+        # stored text for rows from the archive index
+        if isinstance(row['timestamp'], str):
+            row['timestamp'] = parse_datetime(row['timestamp'])
+        if settings.USE_TZ and timezone.is_naive(row['timestamp']):
+            row['timestamp'] = timezone.make_aware(row['timestamp'], dt_timezone.utc)
+    return rows, next_cursor
@@ -1,3 +1,1236 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import unittest
+from datetime import timedelta
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.db import IntegrityError, connection
+from django.db.utils import ConnectionHandler
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import archive, attachments, bench, contact_search, dbwriter, export, history, metrics, search, versions
+from .admin import MessageAdmin, estimated_count
+from .auth import CachedAuthMiddlewareStack
+from .cache import SharedFileCache
+from .directory import UserDirectory, directory
+from .flowcontrol import SendQueue
+from .layers import ChannelHub, UnixSocketChannelLayer
+from .metrics import VIEW_QUERIES, Histogram
+from .presence import PresenceRegistry
+from .writebehind import MessageBuffer
+from .models import Attachment, User, Message, Conversation, MessageArchive
+from .routing import websocket_urlpatterns
+
+# Any full scan of these tables on a hot path is a regression
+FULL_SCAN = re.compile(r'\bSCAN (TABLE )?chatapp_(message|conversation)\b')
+
+
+class ChatTestCase(TestCase):
+    """A therapist and a client, an empty directory and cache, and sockets between them."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.therapist = User.objects.create(username='therapist', is_therapist=True)
+        cls.client_user = User.objects.create(username='client')
+
+    def setUp(self):
+        # Both outlive the test's transaction
+        directory.clear()
+        cache.clear()
+
+    def communicator(self, user, other=None, **query):
+        # The room with `other`, or the inbox socket without one
+        path = f'/ws/chat/{other.username}/' if other is not None else '/ws/notify/'
+        if query:
+            path += '?' + urlencode(query)
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        communicator.scope['user'] = user
+        return communicator
+
+    async def connect(self, user, other=None, **query):
+        communicator = self.communicator(user, other, **query)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+
+class HotPathQueryTests(ChatTestCase):
+    THERAPISTS = 10
+    CLIENTS = 200
+    MESSAGES_PER_PAIR = 30
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.therapists = User.objects.bulk_create([
+            User(username=f'therapist{i}', is_therapist=True) for i in range(cls.THERAPISTS)
+        ])
+        cls.clients = User.objects.bulk_create([
+            User(username=f'client{i}') for i in range(cls.CLIENTS)
+        ])
+        cls.therapist = cls.therapists[0]
+        cls.client_user = cls.clients[0]
+
+        # Every client talks to one therapist, with a few unread messages each
+        messages, conversations = [], []
+        for i, client in enumerate(cls.clients):
+            therapist = cls.therapists[i % cls.THERAPISTS]
+            for n in range(cls.MESSAGES_PER_PAIR):
+                if n % 2:
+                    messages.append(Message(sender=therapist, receiver=client, content=f'reply {n}', is_read=True))
+                else:
+                    messages.append(Message(sender=client, receiver=therapist, content=f'hello {n}', is_read=n > 20))
+            a, b = Conversation.pair(client.id, therapist.id)
+            conversations.append(Conversation(user_a_id=a, user_b_id=b))
+        Message.objects.bulk_create(messages, batch_size=1000)
+
+        for conversation, last in zip(conversations, messages[cls.MESSAGES_PER_PAIR - 1::cls.MESSAGES_PER_PAIR]):
+            conversation.last_message = last
+            conversation.last_timestamp = last.timestamp
+            if conversation.user_a_id == last.receiver_id:
+                conversation.unread_b = 11
+            else:
+                conversation.unread_a = 11
+        Conversation.objects.bulk_create(conversations)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertNoFullScans(self, queries):
+        checked = 0
+        with connection.cursor() as cursor:
+            for query in queries:
+                sql = query['sql']
+                if not sql.startswith(('SELECT', 'UPDATE', 'DELETE')) or 'chatapp_' not in sql:
+                    continue
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                plan = '\n'.join(row[-1] for row in cursor.fetchall())
+                self.assertIsNone(FULL_SCAN.search(plan), f'{sql}\n{plan}')
+                checked += 1
+        self.assertGreater(checked, 0)
+
+    def test_chat_home_therapist(self):
+        self.client.force_login(self.therapist)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/chat/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['contacts']), self.CLIENTS // self.THERAPISTS)
+        # The session user, the conversations, and one directory fill
+        self.assertLessEqual(len(queries), 3)
+        self.assertNoFullScans(queries)
+
+    def test_chat_home_client(self):
+        self.client.force_login(self.client_user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/chat/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['contacts']), self.THERAPISTS)
+        self.assertLessEqual(len(queries), 4)
+        self.assertNoFullScans(queries)
+
+    def test_chat_home_filter_keeps_substring_matches(self):
+        self.client.force_login(self.therapist)
+        response = self.client.get('/chat/', {'q': 'ent1'})
+        # client10 and client100-190, what username__icontains used to find
+        self.assertEqual(len(response.context['contacts']), 11)
+        response = self.client.get('/chat/', {'q': 'client'})
+        self.assertEqual(len(response.context['contacts']), self.CLIENTS // self.THERAPISTS)
+
+    def test_chat_home_filter_ranks_and_tolerates_typos(self):
+        self.client.force_login(self.client_user)
+        response = self.client.get('/chat/', {'q': 'therapist1'})
+        self.assertEqual(response.context['contacts'][0]['username'], 'therapist1')
+        response = self.client.get('/chat/', {'q': 'therpist3'})
+        self.assertEqual(response.context['contacts'][0]['username'], 'therapist3')
+
+    def test_chat_view(self):
+        self.client.force_login(self.therapist)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/chat/{self.client_user.username}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['messages']), self.MESSAGES_PER_PAIR)
+        self.assertLessEqual(len(queries), 6)
+        self.assertNoFullScans(queries)
+
+    def test_chat_history(self):
+        self.client.force_login(self.therapist)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/chat/{self.client_user.username}/history/', {
+                'before': f'{2**52}_{2**40}',
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(queries), 4)
+        self.assertNoFullScans(queries)
+
+    def test_async_views_record_queries(self):
+        self.client.force_login(self.therapist)
+        before = VIEW_QUERIES._values.get(('chat_view',), [0])[-1]
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(f'/chat/{self.client_user.username}/')
+        self.assertGreater(len(queries), 0)
+        self.assertEqual(VIEW_QUERIES._values[('chat_view',)][-1] - before, len(queries))
+
+    @override_settings(CHAT_PROFILER_ENABLED=True)
+    def test_async_views_profile(self):
+        staff = User.objects.create(username='staff', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get('/chat/', {'profile': '1'})
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.client.force_login(self.therapist)
+        response = self.client.get('/chat/', {'profile': '1'})
+        self.assertNotEqual(response['Content-Type'], 'text/plain')
+
+    def test_consumer_receive(self):
+        async def send_one():
+            communicator = await self.connect(self.client_user, self.therapist)
+            await communicator.send_json_to({'message': 'hello'})
+            await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(send_one)()
+        self.assertLessEqual(len(queries), 8)
+        self.assertNoFullScans(queries)
+
+
+class BenchmarkSmokeTests(TestCase):
+    def test_report(self):
+        report = bench.run(pairs=3, messages=2, rate=0)
+        results = report['results']
+        self.assertEqual(results['messages_delivered'], 6)
+        self.assertEqual(results['messages_stored'], 6)
+        self.assertIsNotNone(results['latency_ms']['p99'])
+        self.assertGreater(results['db_writes_per_s'], 0)
+        self.assertFalse(User.objects.filter(username__startswith=bench.PREFIX).exists())
+
+    def test_report_past_rate_burst(self):
+        report = bench.run(pairs=1, messages=30, rate=0)
+        self.assertEqual(report['results']['messages_delivered'], 30)
+        self.assertEqual(report['results']['messages_rejected'], 0)
+
+    @override_settings(CHAT_RATE_LIMIT=0.001, CHAT_RATE_BURST=5)
+    def test_rejected_messages_are_counted(self):
+        users = bench.create_users(1)
+        try:
+            with mock.patch.object(bench, 'RECEIVE_TIMEOUT', 0.5):
+                _, delivered, rejected, _, _ = async_to_sync(bench.run_load)(users, 10, 0)
+        finally:
+            bench.delete_users()
+        self.assertEqual((delivered, rejected), (5, 5))
+
+    def test_compare_flags_regressions(self):
+        baseline = {'results': {'messages_per_s': 100.0, 'latency_ms': {'p95': 10.0}}}
+        current = {'results': {'messages_per_s': 80.0, 'latency_ms': {'p95': 10.5}}}
+        regressed = {key for key, _, _, _, worse in bench.compare(current, baseline) if worse}
+        self.assertEqual(regressed, {'messages_per_s'})
+
+
+class AttachmentUploadTests(ChatTestCase):
+    DATA = b'x' * 50000
+
+    def setUp(self):
+        super().setUp()
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = root.name
+        patcher = mock.patch.object(attachments, 'ROOT', self.root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stored_files(self):
+        return [name for _, _, files in os.walk(self.root) for name in files]
+
+    def upload(self, user):
+        sha = hashlib.sha256(self.DATA).hexdigest()
+
+        async def send():
+            communicator = await self.connect(user, self.therapist)
+            await communicator.send_json_to({'type': 'upload', 'name': 'notes.txt', 'size': len(self.DATA), 'sha256': sha})
+            await communicator.receive_json_from()
+            await communicator.send_to(bytes_data=(0).to_bytes(8, 'big') + self.DATA)
+            frames = [await communicator.receive_json_from(), await communicator.receive_json_from()]
+            await communicator.disconnect()
+            return frames
+
+        return async_to_sync(send)()
+
+    def test_anonymous_socket_is_refused(self):
+        connected, _ = async_to_sync(self.communicator(AnonymousUser(), self.therapist).connect)()
+        self.assertFalse(connected)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_upload_stores_blob_and_row_together(self):
+        frames = self.upload(self.client_user)
+        self.assertEqual(frames[-1]['message'], 'notes.txt')
+        attachment = Attachment.objects.get()
+        self.assertTrue(os.path.exists(attachments.blob_path(attachment.sha256)))
+        self.assertEqual(Message.objects.get().attachment, attachment)
+
+    def test_failed_save_leaves_no_blob(self):
+        with mock.patch.object(Conversation, 'record_message', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.upload(self.client_user)
+        self.assertFalse(Attachment.objects.exists())
+        sha = hashlib.sha256(self.DATA).hexdigest()
+        self.assertFalse(os.path.exists(attachments.blob_path(sha)))
+
+    def test_download_honours_range(self):
+        self.upload(self.client_user)
+        message = Message.objects.get()
+        self.client.force_login(self.therapist)
+        url = f'/attachments/{message.id}/'
+        response = self.client.get(url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.DATA)}')
+        self.assertEqual(b''.join(response.streaming_content), self.DATA[100:200])
+        response = self.client.get(url, HTTP_RANGE='bytes=-0')
+        self.assertEqual(response.status_code, 416)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=f'"{message.attachment.sha256}"')
+        self.assertEqual(response.status_code, 304)
+        # Only the two people in the conversation
+        self.client.force_login(User.objects.create(username='stranger'))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    @override_settings(CHAT_ATTACHMENT_BYTES_PER_SECOND=1000000, CHAT_ATTACHMENT_BURST_BYTES=1024)
+    def test_chunks_are_held_to_the_byte_budget(self):
+        throttled = metrics.UPLOAD_THROTTLED.value()
+        frames = self.upload(self.client_user)
+        self.assertEqual(frames[-1]['message'], 'notes.txt')
+        self.assertGreater(metrics.UPLOAD_THROTTLED.value(), throttled)
+
+    def test_unfinished_uploads_are_capped_per_user(self):
+        os.makedirs(os.path.join(self.root, 'partial'))
+        for i in range(attachments.MAX_PARTIALS):
+            open(os.path.join(self.root, 'partial', f'{self.client_user.id}-{i:064x}'), 'wb').close()
+
+        async def announce(user, other):
+            communicator = await self.connect(user, other)
+            sha = hashlib.sha256(self.DATA).hexdigest()
+            await communicator.send_json_to({'type': 'upload', 'name': 'notes.txt', 'size': len(self.DATA), 'sha256': sha})
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        self.assertEqual(async_to_sync(announce)(self.client_user, self.therapist)['error'], 'Too many unfinished uploads')
+        # Someone else's are theirs
+        self.assertEqual(async_to_sync(announce)(self.therapist, self.client_user)['offset'], 0)
+
+    def test_stale_partials_already_gone_are_skipped(self):
+        partial = os.path.join(self.root, 'partial')
+        os.makedirs(partial)
+        for name in ('1-a', '1-b'):
+            open(os.path.join(partial, name), 'wb').close()
+            os.utime(os.path.join(partial, name), (0, 0))
+        real_remove = os.remove
+
+        def remove(path):
+            # Another worker swept 1-a between our scandir and remove
+            if path.endswith('1-a'):
+                real_remove(path)
+                raise FileNotFoundError(path)
+            real_remove(path)
+
+        with mock.patch('chatapp.attachments.os.remove', remove):
+            self.assertEqual(attachments.remove_stale_partials(60), 1)
+        self.assertEqual(os.listdir(partial), [])
+
+    def test_parse_range(self):
+        self.assertEqual(attachments.parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(attachments.parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(attachments.parse_range('bytes=900-', 1000), (900, 999))
+        # An empty suffix and a start past the end can't be satisfied
+        self.assertIs(attachments.parse_range('bytes=-0', 1000), False)
+        self.assertIs(attachments.parse_range('bytes=1000-', 1000), False)
+        self.assertIsNone(attachments.parse_range('bytes=0-1,5-9', 1000))
+
+
+class PresenceTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('chatapp.presence.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+        self.presence = PresenceRegistry(ttl=60, worker='a')
+
+    def test_heartbeat_after_expiry_brings_user_back(self):
+        self.presence.connect(1)
+        self.now += 61
+        self.assertFalse(self.presence.is_online(1))
+        self.presence.heartbeat(1)
+        self.assertTrue(self.presence.is_online(1))
+
+    def test_tabs_are_still_counted_after_expiry(self):
+        self.presence.connect(1)
+        self.presence.connect(1)
+        self.now += 61
+        self.assertFalse(self.presence.is_online(1))
+        # One tab closes, the other one is still open and heartbeating
+        self.presence.disconnect(1)
+        self.presence.heartbeat(1)
+        self.assertTrue(self.presence.is_online(1))
+        self.presence.disconnect(1)
+        self.assertFalse(self.presence.is_online(1))
+        self.presence.heartbeat(1)
+        self.assertFalse(self.presence.is_online(1))
+
+    def test_workers_share_presence(self):
+        # Two worker processes, one cache
+        other = PresenceRegistry(ttl=60, worker='b')
+        self.presence.connect(1)
+        other.connect(2)
+        other.connect(1)
+        self.assertEqual(self.presence.online([1, 2, 3]), {1, 2})
+        self.assertEqual(other.online([1, 2, 3]), {1, 2})
+        # Still open on the other worker
+        self.presence.disconnect(1)
+        self.assertTrue(self.presence.is_online(1))
+        other.disconnect(1)
+        self.assertFalse(self.presence.is_online(1))
+        # Heartbeats keep the entry alive, but only write it every ttl/2
+        with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            for _ in range(9):
+                self.now += 10
+                other.heartbeat(2)
+        self.assertEqual(cache_set.call_count, 2)
+        self.assertTrue(self.presence.is_online(2))
+
+
+class VersionTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_bump_does_not_read_the_counter(self):
+        name = versions.inbox(1)
+        before, = versions.get(name)
+        # incr() reads then writes, which loses bumps in the shared file cache
+        with mock.patch.object(cache, 'incr', side_effect=AssertionError):
+            versions.bump(name)
+        self.assertNotEqual(versions.get(name), (before,))
+
+    def test_shared_file_cache_culls_in_background(self):
+        with tempfile.TemporaryDirectory() as location:
+            shared = SharedFileCache(location, {'OPTIONS': {'MAX_ENTRIES': 5, 'CULL_INTERVAL': 60}})
+            with mock.patch.object(FileBasedCache, '_cull') as cull:
+                for i in range(20):
+                    shared.set(f'key{i}', i)
+                for thread in threading.enumerate():
+                    if thread.name == 'chat-cache-cull':
+                        thread.join()
+            self.assertEqual(cull.call_count, 1)
+            self.assertEqual(shared.get('key19'), 19)
+
+
+class DirectoryTests(TestCase):
+    def setUp(self):
+        directory.clear()
+        cache.clear()
+
+    def test_other_worker_sees_user_changes(self):
+        therapist = User.objects.create(username='therapist', is_therapist=True)
+        # Another runworkers process: same shared cache, own directory, and
+        # the save signal never reaches it
+        worker = UserDirectory(max_size=100)
+        self.assertEqual([entry.username for entry in worker.therapists()], ['therapist'])
+        self.assertEqual(worker.get('therapist').id, therapist.id)
+
+        with mock.patch('chatapp.directory.directory', UserDirectory(max_size=100)):
+            with self.captureOnCommitCallbacks(execute=True):
+                therapist.username = 'renamed'
+                therapist.save()
+
+        self.assertIsNone(worker.get('therapist'))
+        self.assertEqual(worker.get('renamed').id, therapist.id)
+        self.assertEqual([entry.username for entry in worker.therapists()], ['renamed'])
+
+    def test_rows_read_under_an_old_version_are_not_kept(self):
+        user = User.objects.create(username='client')
+        found, missing, version = directory._cached_many([user.id])
+        versions.bump(versions.DIRECTORY)
+        directory._check_version()
+        directory._remember_rows([(user.id, 'client', False)], found, version)
+        self.assertEqual(directory._cached_many([user.id])[1], [user.id])
+
+
+class ArchiverTests(SimpleTestCase):
+    def run_pass(self):
+        # In a thread, like archive_periodically: the pass closes its connection
+        with mock.patch.object(archive, 'archive_old_messages', return_value=3) as archive_old_messages:
+            result = []
+            thread = threading.Thread(target=lambda: result.append(archive.archive_pass()))
+            thread.start()
+            thread.join()
+        return result[0], archive_old_messages.called
+
+    @unittest.skipIf(archive.fcntl is None, 'needs fcntl')
+    def test_one_process_archives_at_a_time(self):
+        with tempfile.TemporaryDirectory() as location:
+            with mock.patch.object(archive, 'LOCK_PATH', os.path.join(location, 'archive.lock')):
+                with archive.archiver_lock() as acquired:
+                    self.assertTrue(acquired)
+                    self.assertEqual(self.run_pass(), (0, False))
+                self.assertEqual(self.run_pass(), (3, True))
+
+
+class SendQueueTests(SimpleTestCase):
+    def fill(self, policy):
+        sent = []
+
+        async def send(frame):
+            sent.append(frame)
+
+        async def put():
+            queue = SendQueue(send, 2, policy)
+            # Nothing drains until we yield, like a reader that stopped
+            results = [queue.put(f'message {i}') for i in range(3)]
+            queue.close()
+            return results
+
+        return async_to_sync(put)()
+
+    def test_default_overflow_disconnects(self):
+        # The client reconnects and replays, nothing is lost silently
+        self.assertEqual(self.fill(settings.CHAT_SEND_OVERFLOW), [True, True, False])
+
+    def test_coalesce_drops_unkeyed_frames(self):
+        self.assertEqual(self.fill('coalesce'), [True, True, True])
+
+    def test_failed_send_keeps_draining(self):
+        sent = []
+
+        async def send(frame):
+            if frame == 'bad':
+                raise ValueError(frame)
+            sent.append(frame)
+
+        async def run():
+            queue = SendQueue(send, 10, 'drop')
+            for frame in ('one', 'bad', 'two'):
+                queue.put(frame)
+            await asyncio.sleep(0)
+            queue.put('three')
+            await asyncio.sleep(0)
+            queue.close()
+
+        with self.assertLogs('chatapp.flowcontrol', 'ERROR'):
+            async_to_sync(run)()
+        self.assertEqual(sent, ['one', 'two', 'three'])
+
+
+class ReplayTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.messages = [
+            Message.objects.create(sender=cls.client_user, receiver=cls.therapist, content=f'hello {n}')
+            for n in range(5)
+        ]
+
+    def replay(self, after):
+        async def connect():
+            communicator = await self.connect(self.therapist, self.client_user, after=after)
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        return async_to_sync(connect)()
+
+    def test_replays_messages_after_the_last_rendered_one(self):
+        frame = self.replay(self.messages[2].id)
+        self.assertEqual(frame['type'], 'replay')
+        self.assertEqual([m['id'] for m in frame['messages']], [m.id for m in self.messages[3:]])
+
+    def test_empty_room_replays_everything(self):
+        # A page rendered before the first message sends after=0
+        frame = self.replay(0)
+        self.assertEqual(len(frame['messages']), 5)
+
+    @override_settings(CHAT_REPLAY_MAX=1, CHAT_REPLAY_BATCH=2)
+    def test_too_far_behind_resyncs(self):
+        self.assertEqual(self.replay(0), {'type': 'resync'})
+
+
+class WriteBehindTests(ChatTestCase):
+    def flush(self, messages):
+        async def run():
+            buffer = MessageBuffer(interval=60, batch_size=1000)
+            futures = [buffer.add(message) for message in messages]
+            await buffer.close()
+            return [future.exception() or future.result() for future in futures]
+
+        return async_to_sync(run)()
+
+    def message(self, content, receiver_id=None):
+        return Message(sender=self.client_user, receiver_id=receiver_id or self.therapist.id, content=content)
+
+    def test_missing_receiver_only_fails_its_message(self):
+        results = self.flush([self.message('one'), self.message('lost', receiver_id=10 ** 6), self.message('two')])
+        self.assertIsInstance(results[1], User.DoesNotExist)
+        self.assertEqual([results[0].content, results[2].content], ['one', 'two'])
+        self.assertEqual(list(Message.objects.values_list('content', flat=True).order_by('id')), ['one', 'two'])
+        self.assertEqual(Conversation.objects.get().unread_for(self.therapist), 2)
+
+    def test_failed_batch_is_retried_row_by_row(self):
+        record_messages = Conversation.record_messages
+
+        def fail_on_bad(messages):
+            if any(message.content == 'bad' for message in messages):
+                raise IntegrityError('bad row')
+            return record_messages(messages)
+
+        with mock.patch.object(Conversation, 'record_messages', side_effect=fail_on_bad):
+            results = self.flush([self.message('one'), self.message('bad'), self.message('two')])
+        self.assertIsInstance(results[1], IntegrityError)
+        self.assertEqual(list(Message.objects.values_list('content', flat=True).order_by('id')), ['one', 'two'])
+
+
+class WalTests(SimpleTestCase):
+    # Lets the test open its own connection to a file database
+    databases = {'default'}
+
+    def test_wal_is_switched_on_by_the_server_only(self):
+        self.assertNotIn('journal_mode', settings.DATABASES['default']['OPTIONS']['init_command'])
+        with tempfile.TemporaryDirectory() as root:
+            databases = ConnectionHandler({'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(root, 'db.sqlite3'),
+                'OPTIONS': settings.DATABASES['default']['OPTIONS'],
+            }})
+            try:
+                with databases['default'].cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode')
+                    self.assertEqual(cursor.fetchone()[0], 'delete')
+                self.assertEqual(dbwriter.use_wal(databases['default']), 'wal')
+            finally:
+                databases.close_all()
+
+
+@override_settings(CHAT_METRICS_TOKEN='s3cret', CHAT_METRICS_ALLOWED_IPS=[])
+class MetricsAccessTests(TestCase):
+    def test_local_address_is_not_enough(self):
+        # Behind the proxy every request comes from 127.0.0.1
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer nope').status_code, 403)
+
+    @override_settings(CHAT_METRICS_TOKEN='')
+    def test_no_token_configured(self):
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+    def test_staff(self):
+        self.client.force_login(User.objects.create(username='admin', is_staff=True))
+        self.assertEqual(self.client.get('/metrics/').status_code, 200)
+
+    def test_histogram_text_format(self):
+        histogram = Histogram('test_seconds', 'Test.', ['phase'], buckets=(0.1, 1))
+        self.addCleanup(metrics.registry.remove, histogram)
+        histogram.observe(0.05, phase='db')
+        histogram.observe(0.5, phase='db')
+        histogram.observe(5, phase='db')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{phase="db",le="0.1"} 1',
+            'test_seconds_bucket{phase="db",le="1"} 2',
+            'test_seconds_bucket{phase="db",le="+Inf"} 3',
+            'test_seconds_sum{phase="db"} 5.55',
+            'test_seconds_count{phase="db"} 3',
+        ])
+
+    @override_settings(CHAT_METRICS_ALLOWED_IPS=['127.0.0.1'])
+    def test_trusted_address(self):
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE chat_connections gauge', response.content)
+
+
+class ConversationTests(ChatTestCase):
+    def send(self, sender, receiver, content):
+        message = Message.objects.create(sender=sender, receiver=receiver, content=content)
+        Conversation.record_message(message)
+        return message
+
+    def test_messages_update_one_row_per_pair(self):
+        self.send(self.client_user, self.therapist, 'one')
+        self.send(self.client_user, self.therapist, 'two')
+        last = self.send(self.therapist, self.client_user, 'three')
+        conversation = Conversation.objects.get()
+        self.assertEqual((conversation.last_message, conversation.last_timestamp), (last, last.timestamp))
+        self.assertEqual(conversation.unread_for(self.therapist), 2)
+        self.assertEqual(conversation.unread_for(self.client_user), 1)
+        self.assertEqual(conversation.other_id(self.therapist), self.client_user.id)
+
+    def test_acknowledge_counts_down_to_the_receipt(self):
+        first = self.send(self.client_user, self.therapist, 'one')
+        self.send(self.client_user, self.therapist, 'two')
+        self.assertEqual(Conversation.acknowledge(self.therapist, self.client_user, upto=first.id), 1)
+        self.assertEqual(Conversation.objects.get().unread_for(self.therapist), 1)
+        self.assertEqual(Conversation.acknowledge(self.therapist, self.client_user), 1)
+        self.assertEqual(Conversation.objects.get().unread_for(self.therapist), 0)
+        # Never below zero, even if the counter was already off
+        Conversation.mark_read(self.therapist, self.client_user, count=5)
+        self.assertEqual(Conversation.objects.get().unread_for(self.therapist), 0)
+
+    def test_inbox_lists_the_conversation_with_its_unread_count(self):
+        self.send(self.client_user, self.therapist, 'one')
+        self.client.force_login(self.therapist)
+        response = self.client.get('/chat/')
+        self.assertEqual(
+            [(contact['username'], contact['unread']) for contact in response.context['contacts']],
+            [('client', 1)],
+        )
+
+
+class HistoryTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.messages = Message.objects.bulk_create([
+            Message(sender=cls.client_user, receiver=cls.therapist, content=f'hello {n}') for n in range(7)
+        ])
+        # Same timestamp for the middle ones, the id has to break the tie
+        Message.objects.filter(id__in=[m.id for m in cls.messages[2:5]]).update(timestamp=cls.messages[2].timestamp)
+
+    def test_pages_walk_back_without_gaps_or_repeats(self):
+        pages, cursor = [], None
+        while True:
+            page, cursor = async_to_sync(history.aget_page)(self.therapist, self.client_user, before=cursor, limit=3)
+            pages.append([message.id for message in page])
+            if cursor is None:
+                break
+        ids = [m.id for m in self.messages]
+        self.assertEqual(pages, [ids[4:], ids[1:4], ids[:1]])
+
+    def test_history_endpoint(self):
+        self.client.force_login(self.therapist)
+        cursor = history.encode_cursor(Message.objects.get(id=self.messages[3].id))
+        response = self.client.get('/chat/client/history/', {'before': cursor})
+        self.assertEqual([m['message'] for m in response.json()['messages']], ['hello 0', 'hello 1', 'hello 2'])
+        self.assertIsNone(response.json()['cursor'])
+        self.assertEqual(self.client.get('/chat/client/history/', {'before': 'nope'}).status_code, 400)
+
+    def test_out_of_range_cursors_are_bad_requests(self):
+        self.client.force_login(self.therapist)
+        for cursor in ('9' * 40 + '_1', '1_' + '9' * 30, '-' + '9' * 20 + '_1'):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get('/chat/client/history/', {'before': cursor}).status_code, 400)
+
+
+class ChannelLayerTests(SimpleTestCase):
+    def test_workers_reach_each_other_through_the_hub(self):
+        async def run(path):
+            hub = ChannelHub(path)
+            await hub.start()
+            first, second = UnixSocketChannelLayer(path), UnixSocketChannelLayer(path)
+            try:
+                channel = await second.new_channel()
+                await second.group_add('room', channel)
+                await first.group_add('room', await first.new_channel())
+                # Let the hub see both joins
+                while len(hub.groups.get('room', ())) < 2:
+                    await asyncio.sleep(0.01)
+                await first.group_send('room', {'type': 'chat.message', 'text': 'hi'})
+                await first.send(channel, {'type': 'chat.upload', 'data': b'\x00\xff'})
+                received = [
+                    await asyncio.wait_for(second.receive(channel), 5),
+                    await asyncio.wait_for(second.receive(channel), 5),
+                ]
+            finally:
+                await first.close()
+                await second.close()
+                # Let both ends see the connections go before the loop does
+                while hub.workers:
+                    await asyncio.sleep(0.01)
+                await asyncio.sleep(0.01)
+                hub.server.close()
+                await hub.server.wait_closed()
+            return received
+
+        with tempfile.TemporaryDirectory() as root, self.assertLogs('chatapp.layers', 'WARNING'):
+            received = async_to_sync(run)(os.path.join(root, 'layer.sock'))
+        self.assertEqual(received, [
+            {'type': 'chat.message', 'text': 'hi'},
+            {'type': 'chat.upload', 'data': b'\x00\xff'},
+        ])
+
+    def test_without_a_hub_delivers_locally(self):
+        async def run(path):
+            layer = UnixSocketChannelLayer(path)
+            channel = await layer.new_channel()
+            await layer.group_add('room', channel)
+            await layer.group_send('room', {'type': 'chat.message'})
+            return await asyncio.wait_for(layer.receive(channel), 5)
+
+        with tempfile.TemporaryDirectory() as root, self.assertLogs('chatapp.layers', 'WARNING') as logs:
+            self.assertEqual(async_to_sync(run)(os.path.join(root, 'missing.sock')), {'type': 'chat.message'})
+        self.assertIn('delivering locally only', logs.output[0])
+
+    def test_drops_between_reconnects_are_counted(self):
+        async def run(path):
+            layer = UnixSocketChannelLayer(path, reconnect_interval=60)
+            for _ in range(3):
+                await layer.group_send('room', {'type': 'chat.message'})
+            await layer.send('specific.elsewhere!abc', {'type': 'chat.message'})
+
+        dropped = metrics.LAYER_DROPPED.value(op='group_send'), metrics.LAYER_DROPPED.value(op='send')
+        with tempfile.TemporaryDirectory() as root, self.assertLogs('chatapp.layers', 'WARNING') as logs:
+            async_to_sync(run)(os.path.join(root, 'missing.sock'))
+        self.assertEqual(metrics.LAYER_DROPPED.value(op='group_send'), dropped[0] + 3)
+        self.assertEqual(metrics.LAYER_DROPPED.value(op='send'), dropped[1] + 1)
+        # One failed connect, then one warning for the whole window
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('dropping messages', logs.output[1])
+
+
+@override_settings(CHAT_READ_RECEIPT_DELAY=0.05)
+class ReadReceiptTests(ChatTestCase):
+    def test_receipts_within_the_delay_are_one_update(self):
+        async def run():
+            sender = await self.connect(self.client_user, self.therapist)
+            reader = await self.connect(self.therapist, self.client_user)
+            ids = []
+            for text in ('one', 'two', 'three'):
+                await sender.send_json_to({'message': text})
+                ids.append((await reader.receive_json_from())['id'])
+                await sender.receive_json_from()
+            await reader.send_json_to({'type': 'read', 'upto': ids[0]})
+            await reader.send_json_to({'type': 'read', 'upto': ids[1]})
+            receipts = [await sender.receive_json_from(), await reader.receive_json_from()]
+            await sender.disconnect()
+            await reader.disconnect()
+            return ids, receipts
+
+        with CaptureQueriesContext(connection) as queries:
+            ids, receipts = async_to_sync(run)()
+        self.assertEqual(receipts, [{'type': 'read', 'reader': 'therapist', 'upto': ids[1]}] * 2)
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "chatapp_message"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(list(Message.objects.filter(is_read=False).values_list('id', flat=True)), ids[2:])
+        self.assertEqual(Conversation.objects.get().unread_for(self.therapist), 1)
+
+    def test_opening_the_room_marks_nothing_read(self):
+        Conversation.record_message(Message.objects.create(sender=self.client_user, receiver=self.therapist, content='hi'))
+        self.client.force_login(self.therapist)
+        self.client.get('/chat/client/')
+        self.assertTrue(Message.objects.filter(is_read=False).exists())
+        self.assertEqual(Conversation.objects.get().unread_for(self.therapist), 1)
+
+
+class MessageSearchTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.stranger = User.objects.create(username='stranger')
+        Message.objects.bulk_create([
+            Message(sender=cls.client_user, receiver=cls.therapist, content='My anxiety is worse at night'),
+            Message(sender=cls.therapist, receiver=cls.client_user, content='Anxiety <b>often</b> is'),
+            Message(sender=cls.client_user, receiver=cls.therapist, content='Sleep is fine'),
+            Message(sender=cls.stranger, receiver=cls.therapist, content='Anxious about anxiety'),
+        ])
+
+    def test_only_own_conversations_match(self):
+        rows, cursor = search.search(self.client_user, 'anx')
+        self.assertEqual(len(rows), 2)
+        self.assertIsNone(cursor)
+        rows, _ = search.search(self.therapist, 'anxiety')
+        self.assertEqual(len(rows), 3)
+
+    def test_input_is_never_fts_syntax(self):
+        self.assertEqual(search.search(self.client_user, '"anxiety OR sleep*')[0], [])
+        self.assertEqual(search.search(self.client_user, '()')[0], [])
+
+    def test_snippets_are_escaped_and_marked(self):
+        rows, _ = search.search(self.client_user, 'often')
+        self.assertIn('&lt;b&gt;<mark>often</mark>&lt;/b&gt;', rows[0]['snippet'])
+
+    def test_pages_follow_the_cursor(self):
+        seen, cursor = [], None
+        while True:
+            rows, cursor = search.search(self.therapist, 'anxiety', after=cursor, limit=1)
+            seen += [row['id'] for row in rows]
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(len(set(seen)), 3)
+
+    def test_endpoint(self):
+        self.client.force_login(self.client_user)
+        results = self.client.get('/search/messages/', {'q': 'anxiety'}).json()['results']
+        self.assertEqual({result['conversation'] for result in results}, {'therapist'})
+        self.assertEqual(self.client.get('/search/messages/', {'q': 'x', 'cursor': 'nope'}).status_code, 400)
+
+    def test_out_of_range_cursors_are_bad_requests(self):
+        self.client.force_login(self.client_user)
+        for cursor in ('1.0_' + '9' * 30, '1.0_-' + '9' * 30):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get('/search/messages/', {'q': 'anxiety', 'cursor': cursor}).status_code, 400)
+
+
+class ContactSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.therapists = [User.objects.create(username=name, is_therapist=True) for name in ('alice', 'alicia', 'bob')]
+        cls.client_user = User.objects.create(username='client')
+        Conversation.record_message(Message.objects.create(sender=cls.client_user, receiver=cls.therapists[0], content='hi'))
+
+    def test_ranks_prefix_matches_and_typos(self):
+        self.assertEqual([name for _, name, _ in contact_search.search('ali')], ['alice', 'alicia'])
+        self.assertEqual(contact_search.search('alcie')[0][1], 'alice')
+        self.assertEqual(contact_search.search('  '), [])
+
+    def test_index_follows_renames(self):
+        bob = self.therapists[2]
+        bob.username = 'robert'
+        bob.save()
+        self.assertEqual([name for _, name, _ in contact_search.search('rob')], ['robert'])
+        self.assertEqual(contact_search.search('bob'), [])
+
+    def test_endpoint_only_shows_allowed_contacts(self):
+        self.client.force_login(self.client_user)
+        results = self.client.get('/search/contacts/', {'q': 'ali'}).json()['results']
+        self.assertEqual([result['username'] for result in results], ['alice', 'alicia'])
+        # Therapists only find people they talk to
+        self.client.force_login(self.therapists[1])
+        self.assertEqual(self.client.get('/search/contacts/', {'q': 'client'}).json()['results'], [])
+        self.client.force_login(self.therapists[0])
+        results = self.client.get('/search/contacts/', {'q': 'client'}).json()['results']
+        self.assertEqual([result['username'] for result in results], ['client'])
+
+
+class BatchedProtocolTests(ChatTestCase):
+    def exchange(self, texts):
+        async def run():
+            batched = await self.connect(self.therapist, self.client_user, v=2)
+            plain = await self.connect(self.client_user, self.therapist)
+            for text in texts:
+                await plain.send_json_to({'message': text})
+            echoes = [await plain.receive_json_from() for _ in texts]
+            frames = []
+            while sum(len(frame) for frame in frames) < len(texts):
+                frames.append(await batched.receive_json_from())
+            await batched.disconnect()
+            await plain.disconnect()
+            return echoes, frames
+
+        return async_to_sync(run)()
+
+    @override_settings(CHAT_BATCH_WINDOW=0.2)
+    def test_events_in_the_window_share_a_frame(self):
+        echoes, frames = self.exchange(['one', 'two', 'three'])
+        # Protocol v1 sockets still get one object per event
+        self.assertEqual([echo['message'] for echo in echoes], ['one', 'two', 'three'])
+        ids = [echo['id'] for echo in echoes]
+        self.assertEqual(frames, [[['m', ids[0], 'client', 'one'], ['m', ids[1], 'client', 'two'], ['m', ids[2], 'client', 'three']]])
+
+    @override_settings(CHAT_BATCH_WINDOW=0.2, CHAT_BATCH_MAX=2)
+    def test_full_batch_goes_out_at_once(self):
+        _, frames = self.exchange(['one', 'two', 'three'])
+        self.assertEqual([len(frame) for frame in frames], [2, 1])
+
+
+class NotifyTests(ChatTestCase):
+    def test_inbox_events_follow_messages_and_receipts(self):
+        async def run():
+            inbox = await self.connect(self.therapist)
+            sender = await self.connect(self.client_user, self.therapist)
+            reader = await self.connect(self.therapist, self.client_user)
+            await sender.send_json_to({'message': 'one'})
+            message = await reader.receive_json_from()
+            await sender.send_json_to({'message': 'two'})
+            await reader.receive_json_from()
+            await reader.send_json_to({'type': 'read', 'upto': message['id']})
+            events = [await inbox.receive_json_from() for _ in range(4)]
+            for communicator in (inbox, sender, reader):
+                await communicator.disconnect()
+            return events
+
+        with override_settings(CHAT_READ_RECEIPT_DELAY=0.01):
+            events = async_to_sync(run)()
+        self.assertEqual(events, [
+            {'type': 'conversation', 'user': 'client', 'is_therapist': False},
+            {'type': 'unread', 'user': 'client', 'is_therapist': False, 'delta': 1},
+            {'type': 'unread', 'user': 'client', 'is_therapist': False, 'delta': 1},
+            {'type': 'unread', 'user': 'client', 'is_therapist': False, 'delta': -1},
+        ])
+
+    def test_open_inbox_counts_as_online(self):
+        presence = PresenceRegistry(ttl=60)
+
+        async def run():
+            inbox = await self.connect(self.therapist)
+            online = presence.is_online(self.therapist.id)
+            await inbox.disconnect()
+            return online, presence.is_online(self.therapist.id)
+
+        with mock.patch('chatapp.consumers.presence', presence):
+            self.assertEqual(async_to_sync(run)(), (True, False))
+
+    def test_anonymous_notify_socket_is_refused(self):
+        connected, _ = async_to_sync(self.communicator(AnonymousUser()).connect)()
+        self.assertFalse(connected)
+
+
+class ExportTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.therapist = User.objects.create(username='therapist', is_therapist=True)
+        cls.clients = [User.objects.create(username=f'client{n}') for n in range(2)]
+        cls.staff = User.objects.create(username='staff', is_staff=True)
+        for client in cls.clients:
+            for n in range(3):
+                Conversation.record_message(Message.objects.create(sender=client, receiver=cls.therapist, content=f'{client.username} {n}'))
+
+    def export(self, **params):
+        response = self.client.get('/export/', params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_caseload_resumes_after_the_last_row(self):
+        self.client.force_login(self.therapist)
+        rows = [json.loads(line) for line in self.export().splitlines()]
+        self.assertEqual([row['content'] for row in rows], [f'client{c} {n}' for c in range(2) for n in range(3)])
+        rest = [json.loads(line) for line in self.export(after=rows[3]['cursor']).splitlines()]
+        self.assertEqual(rest, rows[4:])
+
+    def test_csv_header_only_on_the_first_part(self):
+        self.client.force_login(self.therapist)
+        lines = self.export(format='csv', **{'with': 'client1'}).splitlines()
+        self.assertEqual(lines[0], ','.join(export.FIELDS))
+        self.assertEqual(len(lines), 4)
+        cursor = lines[1].split(',')[0]
+        self.assertEqual(len(self.export(format='csv', after=cursor, **{'with': 'client1'}).splitlines()), 2)
+
+    def test_access(self):
+        self.client.force_login(self.clients[0])
+        self.assertEqual(self.client.get('/export/').status_code, 403)
+        self.assertEqual(self.client.get('/export/', {'user': 'therapist'}).status_code, 403)
+        self.client.force_login(self.staff)
+        self.assertEqual(len(self.export(user='client0').splitlines()), 3)
+        self.assertEqual(self.client.get('/export/', {'user': 'nobody'}).status_code, 404)
+        self.assertEqual(self.client.get('/export/', {'user': 'client0', 'format': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.get('/export/', {'user': 'client0', 'after': 'nope'}).status_code, 400)
+
+    def test_out_of_range_cursors_are_bad_requests(self):
+        self.client.force_login(self.therapist)
+        for cursor in ('1:' + '9' * 40 + '_1', '1:1_' + '9' * 30, '9' * 30 + ':1_1'):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get('/export/', {'after': cursor}).status_code, 400)
+
+
+class MessageAdminTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = User.objects.create(username='admin', is_staff=True, is_superuser=True)
+        cls.therapist = User.objects.create(username='therapist', is_therapist=True)
+        cls.clients = [User.objects.create(username=f'client{n}') for n in range(2)]
+        cls.messages = []
+        for n in range(5):
+            client = cls.clients[n % 2]
+            message = Message.objects.create(sender=client, receiver=cls.therapist, content=f'hello {n}')
+            Conversation.record_message(message)
+            cls.messages.append(message)
+
+    def setUp(self):
+        self.client.force_login(self.admin_user)
+        patcher = mock.patch.object(MessageAdmin, 'list_per_page', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pages_follow_the_cursor(self):
+        seen, params = [], {}
+        while True:
+            response = self.client.get('/admin/chatapp/message/', params)
+            self.assertEqual(response.status_code, 200)
+            changelist = response.context['cl']
+            seen += [message.id for message in changelist.result_list]
+            if changelist.next_cursor is None:
+                break
+            params = {'cursor': changelist.next_cursor}
+        self.assertEqual(seen, [message.id for message in reversed(self.messages)])
+
+    def test_conversation_filter(self):
+        a, b = Conversation.pair(self.therapist.id, self.clients[0].id)
+        conversation = Conversation.objects.get(user_a_id=a, user_b_id=b)
+        response = self.client.get('/admin/chatapp/message/', {'conversation': conversation.id})
+        self.assertEqual({message.sender_id for message in response.context['cl'].result_list}, {self.clients[0].id})
+
+    def test_bad_cursors_are_bad_requests(self):
+        for cursor in ('nope', '9' * 40 + '_1', '1_' + '9' * 30):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get('/admin/chatapp/message/', {'cursor': cursor}).status_code, 400)
+
+    def test_estimated_count(self):
+        self.assertEqual(estimated_count(Message.objects.all(), limit=10), (5, True))
+        # Unfiltered, the id range stands in for the count
+        self.assertEqual(estimated_count(Message.objects.all(), limit=2), (5, False))
+        self.assertEqual(estimated_count(Message.objects.filter(is_read=False), limit=2), (2, False))
+
+
+class TypingTests(ChatTestCase):
+    def run_room(self, script):
+        async def run():
+            typist = await self.connect(self.client_user, self.therapist)
+            watcher = await self.connect(self.therapist, self.client_user)
+            try:
+                return await script(typist, watcher)
+            finally:
+                await typist.disconnect()
+                await watcher.disconnect()
+
+        return async_to_sync(run)()
+
+    @override_settings(CHAT_TYPING_INTERVAL=10)
+    def test_repeats_are_throttled_and_never_stored(self):
+        async def script(typist, watcher):
+            for _ in range(5):
+                await typist.send_json_to({'type': 'typing'})
+            started = await watcher.receive_json_from()
+            await typist.send_json_to({'type': 'typing', 'typing': False})
+            stopped = await watcher.receive_json_from()
+            # Nothing else went out, and the typist hears nothing of its own
+            self.assertTrue(await watcher.receive_nothing(0.05))
+            self.assertTrue(await typist.receive_nothing(0.05))
+            return started, stopped
+
+        with CaptureQueriesContext(connection) as queries:
+            started, stopped = self.run_room(script)
+        self.assertEqual(started, {'type': 'typing', 'user': 'client', 'typing': True})
+        self.assertEqual(stopped, {'type': 'typing', 'user': 'client', 'typing': False})
+        self.assertFalse([q for q in queries if 'chatapp_message' in q['sql']])
+
+    @override_settings(CHAT_TYPING_TIMEOUT=0.05)
+    def test_a_start_nobody_repeats_expires(self):
+        async def script(typist, watcher):
+            await typist.send_json_to({'type': 'typing'})
+            return [await watcher.receive_json_from(), await watcher.receive_json_from()]
+
+        self.assertEqual([frame['typing'] for frame in self.run_room(script)], [True, False])
+
+
+class CachedAuthTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='client', password='old-password-1')
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def user_queries(self, queries):
+        return [q['sql'] for q in queries if 'FROM "chatapp_user"' in q['sql'] or 'FROM "django_session"' in q['sql']]
+
+    def test_second_request_needs_no_session_or_user_query(self):
+        self.client.get('/chat/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/chat/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.user_queries(queries), [])
+
+    def test_password_change_logs_the_session_out(self):
+        self.assertEqual(self.client.get('/chat/').status_code, 200)
+        self.user.set_password('new-password-2')
+        self.user.save()
+        response = self.client.get('/chat/')
+        self.assertEqual(response.status_code, 302)
+
+    def test_websocket_handshake_from_the_cache(self):
+        cookie = f'{settings.SESSION_COOKIE_NAME}={self.client.session.session_key}'.encode()
+
+        async def connect():
+            communicator = WebsocketCommunicator(
+                CachedAuthMiddlewareStack(URLRouter(websocket_urlpatterns)), '/ws/notify/', headers=[(b'cookie', cookie)],
+            )
+            connected, _ = await communicator.connect()
+            await communicator.disconnect()
+            return connected
+
+        self.assertTrue(async_to_sync(connect)())
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(async_to_sync(connect)())
+        self.assertEqual(self.user_queries(queries), [])
+
+
+class ArchiveTests(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.messages = []
+        for n in range(6):
+            message = Message.objects.create(sender=cls.client_user, receiver=cls.therapist, content=f'hello {n}', is_read=n != 4)
+            Conversation.record_message(message)
+            cls.messages.append(message)
+        # All old enough, but the unread one and everything after it stay
+        Message.objects.update(timestamp=timezone.now() - timedelta(days=400))
+
+    def test_old_read_messages_move_and_stay_readable(self):
+        self.assertEqual(archive.archive_old_messages(days=180, chunk_size=3), 4)
+        self.assertEqual(MessageArchive.objects.count(), 2)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('content', flat=True)), ['hello 4', 'hello 5'])
+        # History carries on into the archive
+        page, cursor = async_to_sync(history.aget_page)(self.therapist, self.client_user, limit=10)
+        self.assertEqual([message.content for message in page], [f'hello {n}' for n in range(6)])
+        self.assertIsNone(cursor)
+        self.assertEqual(archive.find_message(self.therapist, self.messages[1].id).content, 'hello 1')
+        self.assertIsNone(archive.find_message(User.objects.create(username='stranger'), self.messages[1].id))
+
+    def test_archived_messages_stay_searchable(self):
+        archive.archive_old_messages(days=180, chunk_size=3)
+        rows, _ = search.search(self.therapist, 'hello')
+        self.assertEqual(sorted(row['id'] for row in rows), [m.id for m in self.messages])
+        self.assertTrue(all(row['timestamp'] < timezone.now() - timedelta(days=399) for row in rows))
+        results = self.client_results('hello 1')
+        self.assertEqual([(r['id'], r['conversation']) for r in results], [(self.messages[1].id, 'therapist')])
+        self.assertEqual(search.search(User.objects.create(username='stranger'), 'hello')[0], [])
+        # The index follows the chunks, and can be rebuilt from them
+        self.assertEqual(archive.reindex(), 4)
+        self.assertEqual(len(search.search(self.therapist, 'hello')[0]), 6)
+        MessageArchive.objects.all().delete()
+        self.assertEqual(len(search.search(self.therapist, 'hello')[0]), 2)
+
+    def client_results(self, query):
+        self.client.force_login(self.client_user)
+        return self.client.get('/search/messages/', {'q': query}).json()['results']
+
+    def test_recent_messages_stay(self):
+        self.assertEqual(archive.archive_old_messages(days=500), 0)
+        self.assertFalse(MessageArchive.objects.exists())
+
+
+class WriteSerializerTests(TransactionTestCase):
+    # The writer thread commits on its own connection, so no TestCase
+    # transaction around it
+
+    def test_a_failing_write_only_rolls_back_itself(self):
+        writer = dbwriter.WriteSerializer(batch_size=10)
+
+        def create(username, fail=False):
+            user = User.objects.create(username=username)
+            if fail:
+                raise ValueError(username)
+            return user.username
+
+        futures = [writer.submit(create, 'one'), writer.submit(create, 'two', fail=True), writer.submit(create, 'three')]
+        try:
+            results = [future.exception(5) or future.result() for future in futures]
+        finally:
+            writer.stop()
+        self.assertEqual(results[0], 'one')
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], 'three')
+        self.assertEqual(set(User.objects.values_list('username', flat=True)), {'one', 'three'})
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import metrics, views
 from django.contrib.auth import views as auth_views
 
 urlpatterns = [
@@ -8,6 +8,12 @@ urlpatterns = [
     path('logout/', views.logout_view, name='logout'),
     path('chat/', views.chat_home, name='chat_home'),
     path('chat/<str:username>/', views.chat_view, name='chat_room'),
+    path('chat/<str:username>/history/', views.chat_history, name='chat_history'),
+    path('search/messages/', views.search_messages, name='search_messages'),
+    path('search/contacts/', views.search_contacts, name='search_contacts'),
+    path('export/', views.export_messages, name='export_messages'),
+    path('attachments/<int:message_id>/', views.download_attachment, name='attachment'),
     path('logout/', auth_views.LogoutView.as_view(), name='logout'),
+    path('metrics/', metrics.metrics_view, name='metrics'),
 
 ]
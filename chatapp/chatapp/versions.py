@@ -0,0 +1,76 @@
+"""
+Version counters for cached renders.
+
+Every user has an inbox version and every pair a conversation version,
+bumped after a message is saved or read. chat_home and chat_view cache
+their query results and fragments under keys that include the current
+version, so a bump makes the old entries unreachable and the cache's
+LRU culling drops them. The same versions make up the ETags.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+
+TIMEOUT = getattr(settings, 'CHAT_CACHE_TIMEOUT', 600)
+
+# Bumped on any User change, for the therapist roster and usernames
+DIRECTORY = 'directory'
+
+
+def inbox(user_id):
+    return f'inbox:{user_id}'
+
+
+def conversation(user_id, other_id):
+    return f'conversation:{min(user_id, other_id)}:{max(user_id, other_id)}'
+
+
+def _key(name):
+    return f'chat:version:{name}'
+
+
+def get(*names):
+    """Return the current version of each name, in order."""
+    keys = [_key(name) for name in names]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            # Start evicted or new counters from the clock, so they can't
+            # come back as a value an old ETag already used
+            cache.add(key, time.time_ns(), None)
+            found[key] = cache.get(key)
+    return tuple(found[key] for key in keys)
+
+
+def bump(*names):
+    # A fresh clock value rather than incr(): the file cache the workers
+    # share reads and writes back on incr, so two bumps at once could
+    # leave the counter where only one of them had put it. A plain set is
+    # one atomic rename, and whichever value wins is new.
+    cache.set_many({_key(name): time.time_ns() for name in names}, None)
+
+
+def bump_conversation(user_id, other_id):
+    bump(inbox(user_id), inbox(other_id), conversation(user_id, other_id))
+
+
+def etag(*parts):
+    return '"%s"' % hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def not_modified(request, tag):
+    """Return a 304 response if the client already has `tag`, else None."""
+    response = get_conditional_response(request, etag=tag)
+    if response is not None:
+        finish(response, tag)
+    return response
+
+
+def finish(response, tag):
+    # Browsers have to revalidate every time, presence can change any second
+    response['ETag'] = tag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
@@ -1,38 +1,49 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect
-from django.contrib.auth import authenticate, login, logout, get_user_model
+from django.contrib.auth import aauthenticate, alogin, alogout, get_user_model
 from .forms import UserSignupForm
 
-from django.contrib.auth.decorators import login_required
-from .models import User, Message
-from django.shortcuts import get_object_or_404
+from .auth import login_required
+from django.core.cache import cache
+from .models import Attachment, Message, Conversation
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from . import archive, attachments, contact_search, export, history, search, versions
+from .directory import directory
+from .metrics import instrument_view
+from .presence import HEARTBEAT_INTERVAL, presence
 
 from django.db.models import Count, Q
 
-def signup_view(request):
+@instrument_view
+async def signup_view(request):
     if request.method == 'POST':
         form = UserSignupForm(request.POST)
-        if form.is_valid():
-            user = form.save()
-            login(request, user)
+        if await sync_to_async(form.is_valid)():
+            # Hashing the password is CPU only, keep it off the shared thread
+            user = await sync_to_async(form.save, thread_sensitive=False)(commit=False)
+            await user.asave()
+            await alogin(request, user)
             return redirect('chat_home')  # we'll create this later
     else:
         form = UserSignupForm()
     return render(request, 'chatapp/signup.html', {'form': form})
 
-def login_view(request):
+@instrument_view
+async def login_view(request):
     if request.method == 'POST':
         username = request.POST['username']
         password = request.POST['password']
-        user = authenticate(request, username=username, password=password)
+        user = await aauthenticate(request, username=username, password=password)
         if user:
-            login(request, user)
+            await alogin(request, user)
             return redirect('chat_home')
         else:
             return render(request, 'chatapp/login.html', {'error': 'Invalid credentials'})
     return render(request, 'chatapp/login.html')
 
-def logout_view(request):
-    logout(request)
+async def logout_view(request):
+    await alogout(request)
     return redirect('login')
 
 # @login_required
@@ -58,55 +69,225 @@ def logout_view(request):
 #     })
 
 
-@login_required
-def chat_home(request):
-    user = request.user
+def contact_row(entry, conversation, user):
+    return {
+        'id': entry.id,
+        'username': entry.username,
+        'unread': conversation.unread_for(user) if conversation else 0,
+        'online': False,
+    }
+
+
+async def inbox_contacts(user):
+    conversations = [conversation async for conversation in Conversation.for_user(user).order_by('-last_timestamp')]
 
     if user.is_therapist:
-        # Therapists see only users who have messaged them
-        therapists_messages = Message.objects.filter(receiver=user).select_related('sender')
-        user_ids = therapists_messages.values_list('sender__id', flat=True).distinct()
-        contacts = User.objects.filter(id__in=user_ids, is_therapist=False)
+        # Therapists see only users they have a conversation with
+        partners = await directory.aget_many([conversation.other_id(user) for conversation in conversations])
+        contacts = []
+        for conversation in conversations:
+            contact = partners.get(conversation.other_id(user))
+            if contact is None or contact.is_therapist:
+                continue
+            contacts.append(contact_row(contact, conversation, user))
     else:
-        # Normal users see all therapists
-        contacts = User.objects.filter(is_therapist=True)
+        # Normal users see all therapists, most recent conversations first
+        activity = {conversation.other_id(user): conversation for conversation in conversations}
+        recent, rest = [], []
+        for contact in await directory.atherapists():
+            conversation = activity.get(contact.id)
+            (recent if conversation else rest).append(contact_row(contact, conversation, user))
+        recent.sort(key=lambda c: activity[c['id']].last_timestamp, reverse=True)
+        contacts = recent + rest
+    return contacts
+
+
+@instrument_view
+@login_required
+async def chat_home(request):
+    user = request.user
+    query = (request.GET.get('q') or '').strip()
+
+    # Read the versions first, a bump while we query just means a newer
+    # result gets cached under the older version
+    version = versions.get(versions.inbox(user.id), versions.DIRECTORY)
+    key = f'chat:inbox:{user.id}:{version[0]}:{version[1]}'
+    contacts = cache.get(key)
+    if contacts is None:
+        contacts = await inbox_contacts(user)
+        cache.set(key, contacts, versions.TIMEOUT)
 
-    # Optional search filter
-    query = request.GET.get('q')
+    # Search ranks the contacts already loaded, by the same trigram score
+    # as the index, without capping them
     if query:
-        contacts = contacts.filter(username__icontains=query)
-
-    # Build unread counts dictionary
-    unread_counts = {
-        contact.username: Message.objects.filter(
-            sender=contact,
-            receiver=user,
-            is_read=False
-        ).count()
-        for contact in contacts
-    }
+        matches = contact_search.filter_names(query, [contact['username'] for contact in contacts])
+        contacts = sorted(
+            (contact for contact in contacts if contact['username'] in matches),
+            key=lambda contact: (-matches[contact['username']], contact['username']),
+        )
+
+    # One read of the shared presence entries for the whole inbox
+    online = presence.online([contact['id'] for contact in contacts])
+    for contact in contacts:
+        contact['online'] = contact['id'] in online
 
-    return render(request, 'chatapp/chat_home.html', {
+    etag = versions.etag(user.id, version, query, sorted(online), HEARTBEAT_INTERVAL)
+    response = versions.not_modified(request, etag)
+    if response is not None:
+        return response
+    return versions.finish(render(request, 'chatapp/chat_home.html', {
         'contacts': contacts,
-        'unread_counts': unread_counts,
-    })
+        'etag': etag,
+        'cache_timeout': versions.TIMEOUT,
+        'heartbeat_interval': HEARTBEAT_INTERVAL,
+    }), etag)
 
 
+@instrument_view
 @login_required
-def chat_view(request, username):
-    other_user = get_object_or_404(User, username=username) # removed ,is_therapist=True in curly braces
-    
-    # Mark unread messages as read
-    Message.objects.filter(sender=other_user, receiver=request.user, is_read=False).update(is_read=True)
-
-    # Get previous messages between the two
-    messages = Message.objects.filter(
-        sender__in=[request.user, other_user],
-        receiver__in=[request.user, other_user]
-    ).order_by('timestamp')
-
-    return render(request, 'chatapp/chat_room.html', {
+async def chat_view(request, username):
+    other_user = await directory.aget(username) # removed ,is_therapist=True in curly braces
+    if other_user is None:
+        raise Http404
+
+    version, = versions.get(versions.conversation(request.user.id, other_user.id))
+    etag = versions.etag(request.user.id, other_user, version, HEARTBEAT_INTERVAL)
+    response = versions.not_modified(request, etag)
+    if response is not None:
+        return response
+
+    # Unread messages are marked read by the room socket's read receipts
+    # Only the latest page is rendered, older ones come from chat_history.
+    # The page is the same for both users, so they share the cache entry.
+    key = f'chat:room:{versions.conversation(request.user.id, other_user.id)}:{version}'
+    page = cache.get(key)
+    if page is None:
+        page = await history.aget_page(request.user, other_user)
+        cache.set(key, page, versions.TIMEOUT)
+    messages, cursor = page
+
+    return versions.finish(render(request, 'chatapp/chat_room.html', {
         'other_user': other_user,
         'messages': messages,
+        'cursor': cursor,
+        'heartbeat_interval': HEARTBEAT_INTERVAL,
+        'chunk_bytes': attachments.CHUNK_BYTES,
+        'etag': etag,
+        'cache_timeout': versions.TIMEOUT,
+    }), etag)
+
+
+@instrument_view
+@login_required
+async def chat_history(request, username):
+    other_user = await directory.aget(username)
+    if other_user is None:
+        raise Http404
+    try:
+        messages, cursor = await history.aget_page(request.user, other_user, before=request.GET.get('before'))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+    return JsonResponse({
+        'messages': [history.serialize_message(msg) for msg in messages],
+        'cursor': cursor,
     })
 
+
+@instrument_view
+@login_required
+def search_messages(request):
+    query = request.GET.get('q', '')
+    try:
+        rows, cursor = search.search(request.user, query, after=request.GET.get('cursor'))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+    users = directory.get_many({row[key] for row in rows for key in ('sender_id', 'receiver_id')})
+    results = []
+    for row in rows:
+        other_id = row['receiver_id'] if row['sender_id'] == request.user.id else row['sender_id']
+        results.append({
+            'id': row['id'],
+            'sender': users[row['sender_id']].username,
+            'conversation': users[other_id].username,
+            'snippet': row['snippet'],
+            'timestamp': row['timestamp'].isoformat(),
+            'rank': row['rank'],
+        })
+
+    return JsonResponse({'results': results, 'cursor': cursor})
+
+
+@instrument_view
+@login_required
+def search_contacts(request):
+    user = request.user
+    only_ids = None
+    if user.is_therapist:
+        only_ids = {conversation.other_id(user) for conversation in Conversation.for_user(user).only('user_a', 'user_b')}
+    matches = contact_search.search(
+        request.GET.get('q', ''),
+        therapists=not user.is_therapist,
+        only_ids=only_ids,
+    )
+    return JsonResponse({
+        'results': [{'username': username, 'score': round(score, 3)} for _, username, score in matches],
+    })
+
+
+@instrument_view
+@login_required
+def export_messages(request):
+    # Therapists export their own caseload, staff anyone's (?user=)
+    owner = request.user
+    username = request.GET.get('user')
+    if username and username != owner.username:
+        if not owner.is_staff:
+            return HttpResponse(status=403)
+        owner = directory.get(username)
+        if owner is None:
+            raise Http404
+    elif not (owner.is_therapist or owner.is_staff):
+        return HttpResponse(status=403)
+
+    # ?with= narrows it down to one conversation
+    other_user = None
+    if request.GET.get('with'):
+        other_user = directory.get(request.GET['with'])
+        if other_user is None:
+            raise Http404
+
+    fmt = request.GET.get('format', 'jsonl')
+    if fmt not in export.FORMATS:
+        return JsonResponse({'error': 'Unknown format'}, status=400)
+    after = request.GET.get('after')
+    if after:
+        try:
+            export.decode_cursor(after)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+    to_lines, content_type = export.FORMATS[fmt]
+    # A resumed CSV continues the earlier file, so no second header
+    lines = to_lines(export.rows(owner, other_user, after), header=not after)
+    if isinstance(request, ASGIRequest):
+        lines = export.aiter_lines(lines)
+    response = StreamingHttpResponse(lines, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="messages-{owner.username}.{fmt}"'
+    return response
+
+
+@instrument_view
+@login_required
+def download_attachment(request, message_id):
+    # Only the two people in the conversation get the file
+    message = Message.objects.filter(
+        Q(sender=request.user) | Q(receiver=request.user), id=message_id,
+    ).only('content', 'attachment_id').first()
+    if message is None:
+        message = archive.find_message(request.user, message_id)
+    if message is None or message.attachment_id is None:
+        raise Http404
+    attachment = Attachment.objects.get(id=message.attachment_id)
+    return attachments.serve(request, attachment, message.content)
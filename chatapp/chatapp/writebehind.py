@@ -0,0 +1,130 @@
+import asyncio
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+from . import dbwriter, lifespan
+from .models import Message, Conversation, User
+
+
+class MessageBuffer:
+    """
+    Collects unsaved messages in memory and writes them with one bulk_create
+    every `interval` seconds or as soon as `batch_size` messages are waiting.
+    add() returns a future that resolves to the saved Message, or raises if
+    that message could not be written.
+    """
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = []
+        self._loop = None
+        self._task = None
+        self._full = None
+
+    def _bind(self, loop):
+        # Consumers run on a single event loop in production, but tests spin
+        # up a fresh loop per async_to_sync call.
+        if self._loop is not loop:
+            self._loop = loop
+            self._task = None
+            self._full = asyncio.Event()
+
+    def add(self, message):
+        loop = asyncio.get_running_loop()
+        self._bind(loop)
+        future = loop.create_future()
+        self._pending.append((message, future))
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        return future
+
+    async def _run(self):
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def flush(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            saved = await dbwriter.write(self.save_batch, [message for message, _ in batch])
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            for (_, future), result in zip(batch, saved):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def close(self):
+        while self._pending:
+            await self.flush()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._task = None
+
+    @staticmethod
+    def save_batch(messages):
+        """Save messages, return the saved Message or the exception it failed with for each."""
+        # A sender or receiver deleted while their message was queued would
+        # fail the whole bulk insert. SQLite only checks foreign keys at the
+        # commit, too late to tell which row it was, so look first.
+        user_ids = {message.sender_id for message in messages} | {message.receiver_id for message in messages}
+        existing = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+        results = [
+            None if message.sender_id in existing and message.receiver_id in existing
+            else User.DoesNotExist('Sender or receiver no longer exists')
+            for message in messages
+        ]
+        valid = [message for message, result in zip(messages, results) if result is None]
+        try:
+            with transaction.atomic():
+                saved = iter(Message.objects.bulk_create(valid))
+                Conversation.record_messages(valid)
+        except DatabaseError:
+            # Something else in the batch is bad: one message at a time, so
+            # only that one fails
+            saved = iter(MessageBuffer.save_one(message) for message in valid)
+        return [result if result is not None else next(saved) for result in results]
+
+    @staticmethod
+    def save_one(message):
+        # bulk_create may have set a pk before the batch rolled back
+        message.pk = None
+        message._state.adding = True
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create([message])
+                Conversation.record_messages([message])
+        except DatabaseError as exc:
+            return exc
+        return message
+
+
+buffer = MessageBuffer(
+    interval=getattr(settings, 'CHAT_WRITE_BEHIND_INTERVAL', 0.005),
+    batch_size=getattr(settings, 'CHAT_WRITE_BEHIND_BATCH', 100),
+)
+
+
+def enabled():
+    return getattr(settings, 'CHAT_WRITE_BEHIND', False)
+
+
+@lifespan.on_shutdown
+async def flush_on_shutdown():
+    await buffer.close()
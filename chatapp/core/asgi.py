@@ -1,17 +1,19 @@
 import os
 from channels.routing import ProtocolTypeRouter, URLRouter
 import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 django.setup()
 from django.core.asgi import get_asgi_application
 import chatapp.routing
-from channels.auth import AuthMiddlewareStack
-
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+import chatapp.lifespan
+from chatapp.auth import CachedAuthMiddlewareStack
 
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "lifespan": chatapp.lifespan.application,
+    "websocket": CachedAuthMiddlewareStack(
         URLRouter(
             chatapp.routing.websocket_urlpatterns
         )
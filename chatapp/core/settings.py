@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -47,7 +48,8 @@ MIDDLEWARE = [
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Django's AuthenticationMiddleware with the user cached, see chatapp.auth
+    'chatapp.auth.CachedAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -78,13 +80,52 @@ ASGI_APPLICATION = 'core.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Applied to every SQLite connection. IMMEDIATE takes the write lock when a
+# transaction starts instead of failing with "database is locked" halfway
+# through it, and timeout is how long to wait for that lock.
+SQLITE_OPTIONS = {
+    'init_command': (
+        'PRAGMA synchronous=NORMAL;'
+        'PRAGMA cache_size=-20000;'
+        'PRAGMA temp_store=MEMORY;'
+        'PRAGMA mmap_size=134217728;'
+    ),
+    'transaction_mode': 'IMMEDIATE',
+    'timeout': 20,
+}
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': SQLITE_OPTIONS,
     }
 }
 
+# The ASGI server switches the database to WAL when it starts, which lets
+# readers run while a write commits. Only the server: WAL sticks to the
+# file and leaves -wal and -shm files next to it, so migrate, shell and the
+# tests leave the checked-in db.sqlite3 alone.
+CHAT_SQLITE_WAL = True
+
+# CHAT_DB_WRITER=1 sends every write from the chat sockets through one
+# writer thread that group-commits them (chatapp.dbwriter), and reads to
+# persistent query_only connections on the same file.
+CHAT_DB_WRITER = os.environ.get('CHAT_DB_WRITER') == '1'
+CHAT_DB_WRITER_BATCH = 200
+if CHAT_DB_WRITER:
+    DATABASES['read'] = {
+        **DATABASES['default'],
+        'OPTIONS': {
+            **SQLITE_OPTIONS,
+            'init_command': SQLITE_OPTIONS['init_command'] + 'PRAGMA query_only=ON;',
+            'transaction_mode': None,
+        },
+        'CONN_MAX_AGE': None,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_ROUTERS = ['chatapp.dbwriter.ReadRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -141,3 +182,141 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Rendered inbox/room fragments and their query results, keyed by the
+# versions in chatapp.versions, plus sessions and logged in users.
+# LocMemCache evicts least recently used entries past MAX_ENTRIES.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chatapp',
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    }
+}
+CHAT_CACHE_TIMEOUT = 600
+
+# Set by "manage.py runworkers" so every worker process joins the same hub
+CHAT_LAYER_SOCKET = os.environ.get('CHAT_LAYER_SOCKET')
+if CHAT_LAYER_SOCKET:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chatapp.layers.UnixSocketChannelLayer",
+            "CONFIG": {"path": CHAT_LAYER_SOCKET},
+        },
+    }
+    # Workers must see each other's version bumps, so share the cache.
+    # chatapp.cache culls in the background every CULL_INTERVAL seconds.
+    CACHES['default'] = {
+        'BACKEND': 'chatapp.cache.SharedFileCache',
+        'LOCATION': os.path.join(os.path.dirname(CHAT_LAYER_SOCKET), 'chatapp-cache'),
+        'OPTIONS': {'MAX_ENTRIES': 50000, 'CULL_INTERVAL': 60},
+    }
+
+# Messages per page in chat_room and the chat_history endpoint
+CHAT_HISTORY_PAGE_SIZE = 50
+
+# Write-behind persistence: broadcast messages immediately and save them
+# with bulk_create every CHAT_WRITE_BEHIND_INTERVAL seconds or every
+# CHAT_WRITE_BEHIND_BATCH messages, whichever comes first
+CHAT_WRITE_BEHIND = False
+CHAT_WRITE_BEHIND_INTERVAL = 0.005
+CHAT_WRITE_BEHIND_BATCH = 100
+
+# Max users kept in the process-local user directory (chatapp.directory)
+CHAT_USER_CACHE_SIZE = 10000
+
+# Presence: clients send a heartbeat frame every CHAT_PRESENCE_HEARTBEAT
+# seconds and are shown offline CHAT_PRESENCE_TTL seconds after the last one
+CHAT_PRESENCE_HEARTBEAT = 25
+CHAT_PRESENCE_TTL = 60
+
+# Read receipts sent within this many seconds are applied as one UPDATE
+CHAT_READ_RECEIPT_DELAY = 0.25
+
+# Results per page from the message search endpoint
+CHAT_SEARCH_PAGE_SIZE = 20
+
+# Trigram similarity (0-1) below which contact search drops a match
+CHAT_CONTACT_MIN_SIMILARITY = 0.2
+
+# /metrics/ is open to staff users and to requests carrying
+# "Authorization: Bearer <CHAT_METRICS_TOKEN>". Behind a proxy every request
+# comes from 127.0.0.1, so addresses are only trusted when listed here.
+CHAT_METRICS_TOKEN = os.environ.get('CHAT_METRICS_TOKEN', '')
+CHAT_METRICS_ALLOWED_IPS = []
+
+# Staff can add ?profile=1 to an instrumented view to get a sampled,
+# collapsed-stack profile of that request instead of the page
+CHAT_PROFILER_ENABLED = DEBUG
+CHAT_PROFILER_INTERVAL = 0.001
+
+# Read messages older than this move to the compressed archive
+# (chatapp.archive), in chunks of CHAT_ARCHIVE_CHUNK_SIZE per conversation.
+# The ASGI server runs the archiver every CHAT_ARCHIVE_INTERVAL seconds,
+# 0 leaves it to the archive_messages command. With several worker
+# processes only the one holding CHAT_ARCHIVE_LOCK runs it.
+CHAT_ARCHIVE_AFTER_DAYS = 180
+CHAT_ARCHIVE_CHUNK_SIZE = 500
+CHAT_ARCHIVE_INTERVAL = 24 * 60 * 60
+CHAT_ARCHIVE_LOCK = BASE_DIR / 'archive.lock'
+
+# Per-socket flow control (chatapp.flowcontrol). Clients may send
+# CHAT_RATE_LIMIT frames a second with bursts of CHAT_RATE_BURST, and no
+# frame over CHAT_MAX_FRAME_BYTES. Each socket queues at most
+# CHAT_SEND_QUEUE_SIZE outbound frames; when a slow reader fills it,
+# CHAT_SEND_OVERFLOW decides: 'drop', 'coalesce' or 'disconnect'. Only
+# 'disconnect' never loses a chat message: the client reconnects with
+# ?after= and gets the missed ones replayed.
+CHAT_RATE_LIMIT = 10
+CHAT_RATE_BURST = 20
+CHAT_MAX_FRAME_BYTES = 16 * 1024
+CHAT_SEND_QUEUE_SIZE = 256
+CHAT_SEND_OVERFLOW = 'disconnect'
+
+# Sockets opened with ?v=2 get events batched: everything arriving within
+# CHAT_BATCH_WINDOW seconds (or CHAT_BATCH_MAX events) goes out as one frame
+CHAT_BATCH_WINDOW = 0.025
+CHAT_BATCH_MAX = 100
+
+# Sockets reconnecting with ?after=<id> get the messages they missed in
+# frames of CHAT_REPLAY_BATCH; past CHAT_REPLAY_MAX the client reloads
+CHAT_REPLAY_BATCH = 100
+CHAT_REPLAY_MAX = 1000
+
+# Typing indicators are never stored. A user's "started typing" reaches
+# the room at most once per CHAT_TYPING_INTERVAL seconds, and goes away by
+# itself when the client stops repeating it for CHAT_TYPING_TIMEOUT
+CHAT_TYPING_INTERVAL = 1.0
+CHAT_TYPING_TIMEOUT = 5
+
+# Sessions are read from the cache and written through to the database,
+# and chatapp.auth caches the logged in user for CHAT_AUTH_CACHE_TIMEOUT
+# seconds, so requests and socket connects usually skip both queries
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+CHAT_AUTH_CACHE_TIMEOUT = 300
+
+# Rows fetched per round trip by the message export
+CHAT_EXPORT_CHUNK_SIZE = 2000
+
+# The Message admin counts up to this many rows, past that it shows an estimate
+CHAT_ADMIN_COUNT_LIMIT = 10000
+
+# Attachments (chatapp.attachments) are stored once per sha256 under
+# CHAT_ATTACHMENT_ROOT. They are uploaded over the chat socket in binary
+# frames of up to CHAT_ATTACHMENT_CHUNK_BYTES, and an upload nobody resumes
+# within CHAT_ATTACHMENT_PARTIAL_TTL seconds is deleted. A user can have at
+# most CHAT_ATTACHMENT_MAX_PARTIALS unfinished uploads holding
+# CHAT_ATTACHMENT_MAX_PARTIAL_BYTES between them, and each socket receives
+# CHAT_ATTACHMENT_BYTES_PER_SECOND on average, bursts of up to
+# CHAT_ATTACHMENT_BURST_BYTES (more is delayed, not refused). When nginx serves
+# CHAT_ATTACHMENT_ROOT as an internal location, set
+# CHAT_ATTACHMENT_ACCEL_REDIRECT to that location's prefix (for example
+# '/protected/attachments/') and downloads are handed to it.
+CHAT_ATTACHMENT_ROOT = BASE_DIR / 'attachments'
+CHAT_ATTACHMENT_MAX_BYTES = 25 * 1024 * 1024
+CHAT_ATTACHMENT_CHUNK_BYTES = 64 * 1024
+CHAT_ATTACHMENT_PARTIAL_TTL = 24 * 60 * 60
+CHAT_ATTACHMENT_MAX_PARTIALS = 5
+CHAT_ATTACHMENT_MAX_PARTIAL_BYTES = 100 * 1024 * 1024
+CHAT_ATTACHMENT_BYTES_PER_SECOND = 2 * 1024 * 1024
+CHAT_ATTACHMENT_BURST_BYTES = 1024 * 1024
+CHAT_ATTACHMENT_ACCEL_REDIRECT = None